@@ -0,0 +1,176 @@
+import asyncio
+import gzip
+import json
+import sys
+
+import aiohttp
+from apscheduler.schedulers.asyncio import AsyncIOScheduler as Scheduler
+from huobi.model.market.trade_detail import TradeDetail
+from huobi.model.market.trade_detail_event import TradeDetailEvent
+from huobi.utils.time_service import get_current_timestamp
+
+from utils import WS_URL, kill_all_threads, logger
+from utils.clock import CLOCK
+from utils.metrics import LATENCY
+from wampyapp import State, WatcherClient, WatcherMasterClient
+from watcher import WATCHER_CHANNEL_NUM, WATCHER_TASK_NUM, init_watcher, trade_detail_callback
+from websocket_handler import HEART_BEAT_MS, RECONNECT_MS, RESTART_MS, RESTART_RANGE
+
+MARKET_WS_URL = f'{WS_URL}/ws'
+
+
+def parse_trade_detail(data) -> TradeDetailEvent:
+    tick = data['tick']
+    event = TradeDetailEvent()
+    event.ch = data['ch']
+    event.id = tick['id']
+    event.ts = tick['ts']
+    for each in tick['data']:
+        detail = TradeDetail()
+        detail.price = each['price']
+        detail.amount = each['amount']
+        detail.tradeId = each['tradeId']
+        detail.ts = each['ts']
+        detail.direction = each['direction']
+        event.data.append(detail)
+    return event
+
+
+class MarketConnection:
+    def __init__(self, session: aiohttp.ClientSession, symbols, callbacks):
+        self.session = session
+        self.symbols = symbols
+        self.callbacks = callbacks
+        self.name = ','.join(symbols)
+        self.restart_ms = RESTART_MS + hash(self) % RESTART_RANGE
+
+    async def run(self):
+        delay = await self.connect()
+        while True:
+            await asyncio.sleep(delay)
+            logger.warning(f'[{self.name}] Reconnect')
+            delay = await self.connect()
+
+    async def connect(self) -> float:
+        try:
+            async with self.session.ws_connect(MARKET_WS_URL, autoping=False) as ws:
+                for symbol in self.symbols:
+                    await ws.send_json({'sub': f'market.{symbol}.trade.detail', 'id': symbol})
+
+                restart_at = get_current_timestamp() + self.restart_ms
+                while True:
+                    try:
+                        msg = await ws.receive(timeout=HEART_BEAT_MS / 1000)
+                    except asyncio.TimeoutError:
+                        logger.warning(f'[{self.name}] No response from server')
+                        return (RECONNECT_MS - HEART_BEAT_MS) / 1000
+
+                    if msg.type != aiohttp.WSMsgType.BINARY:
+                        logger.error(f'[{self.name}] Connection closed, {msg.type}')
+                        break
+
+                    await self.on_message(ws, json.loads(gzip.decompress(msg.data)))
+                    if get_current_timestamp() > restart_at:
+                        return 0.1
+
+        except (aiohttp.ClientError, OSError) as e:
+            logger.error(f'[{self.name}] {e}')
+
+        return RECONNECT_MS / 1000
+
+    async def on_message(self, ws, data):
+        if 'tick' in data:
+            try:
+                self.callbacks[data['ch']](parse_trade_detail(data))
+            except Exception as e:
+                logger.error(f'[{self.name}] {e}')
+
+        elif 'ping' in data:
+            await ws.send_json({'pong': data['ping']})
+
+        elif data.get('status') == 'error':
+            logger.error(f'[{self.name}] {data.get("err-msg")}')
+
+
+class AsyncWatcher:
+    def __init__(self, client: WatcherClient, session: aiohttp.ClientSession):
+        self.client = client
+        self.session = session
+        self.tasks: 'list[asyncio.Task]' = []
+
+    def sub_trade_detail(self, symbols, redis=True, channel_num=WATCHER_CHANNEL_NUM):
+        for start in range(0, len(symbols), channel_num):
+            channel_symbols = symbols[start:start+channel_num]
+            callbacks = {
+                f'market.{symbol}.trade.detail': trade_detail_callback(symbol, self.client, redis=redis)
+                for symbol in channel_symbols
+            }
+            connection = MarketConnection(self.session, channel_symbols, callbacks)
+            self.tasks.append(asyncio.ensure_future(connection.run()))
+
+    async def update_symbols(self):
+        loop = asyncio.get_event_loop()
+        new_symbols, _ = await loop.run_in_executor(None, self.client.market_client.update_symbols_info)
+        if new_symbols:
+            logger.info(f'Find new symbols: {", ".join(new_symbols)}')
+            self.sub_trade_detail(new_symbols)
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+
+async def wait_state(client: WatcherClient, state=State.STARTED):
+    while client.state != state:
+        await asyncio.sleep(1)
+
+async def run(is_master, is_wait_stop):
+    CLOCK.start()
+    scheduler = Scheduler()
+    if is_master:
+        logger.info('Master watcher')
+        client : WatcherMasterClient = init_watcher(WatcherMasterClient)
+        client.get_task(WATCHER_TASK_NUM)
+        scheduler.add_job(client.running, trigger='cron', hour=23, minute=59, second=30)
+        scheduler.add_job(client.stopping, trigger='cron', hour=23, minute=56, second=0)
+        client.starting()
+    else:
+        logger.info('Sub watcher')
+        client : WatcherClient = init_watcher(WatcherClient)
+        client.market_client.reconcile()
+        await wait_state(client, State.STARTED)
+        client.get_task(WATCHER_TASK_NUM)
+
+    if not client.task:
+        return
+
+    logger.info(f'Watcher task are: {", ".join(client.task)}')
+    async with aiohttp.ClientSession() as session:
+        watcher = AsyncWatcher(client, session)
+        watcher.sub_trade_detail(client.task, redis=is_wait_stop)
+        if is_master:
+            scheduler.add_job(watcher.update_symbols, trigger='cron', minute='*/5')
+            if client.market_client.from_cache:
+                scheduler.add_job(watcher.update_symbols)
+        scheduler.start()
+
+        await wait_state(client, State.RUNNING)
+        await wait_state(client, State.STARTED)
+        LATENCY.dump(logger)
+        if is_wait_stop:
+            await wait_state(client, State.STOPPED)
+
+        scheduler.shutdown(wait=False)
+        watcher.stop()
+
+    client.stop()
+    kill_all_threads()
+    logger.info('Watcher stop')
+
+def main():
+    is_master = len(sys.argv) > 1 and sys.argv[1] == 'master'
+    is_wait_stop = len(sys.argv) <= 1 or sys.argv[1] != 'nowait'
+    asyncio.get_event_loop().run_until_complete(run(is_master, is_wait_stop))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''Memory use and drain time of the key and stream trade layouts.
+
+    python -m benchmark.redis_stream [event_num] [symbol_num] [db]
+
+The db must be empty, it is flushed after each layout.
+'''
+import sys
+import time
+
+from benchmark.state import create_events
+from dataset.redis import Redis
+
+
+def fill(redis_conn: Redis, store, events, symbols, chunk=1000):
+    for i in range(0, len(events), chunk):
+        pipeline = redis_conn.pipeline(transaction=False)
+        for index, data in events[i:i+chunk]:
+            redis_conn.write_trade(symbols[index], data, pipeline, store)
+        pipeline.execute()
+
+def drain_key(redis_conn: Redis):
+    num = 0
+    for keys, values in redis_conn.scan_iter_with_data('trade_*', 500):
+        num += len([value.split(b',') for value in values if value])
+        redis_conn.delete(*keys)
+    return num
+
+def drain_stream(redis_conn: Redis, count=5000):
+    num = 0
+    for name in redis_conn.scan_iter('stream_*', 100):
+        while True:
+            entries = redis_conn.xrange(name, count=count)
+            if not entries:
+                break
+
+            num += len([value.split(b',') for _, fields in entries for value in fields.values()])
+            redis_conn.trim_stream(name, entries[-1][0])
+    return num
+
+def main():
+    event_num = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    symbol_num = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    db = int(sys.argv[3]) if len(sys.argv) > 3 else 15
+
+    redis_conn = Redis(db=db)
+    if redis_conn.dbsize():
+        print(f'Redis db {db} is not empty')
+        return
+
+    events = create_events(event_num, symbol_num)
+    symbols = [f'sym{chr(97 + i % 26)}{chr(97 + i // 26 % 26)}usdt' for i in range(symbol_num)]
+    trade_num = sum([len(data) for _, data in events])
+    print(f'{trade_num} trades in {event_num} events of {symbol_num} symbols')
+
+    for store, drain in [('key', drain_key), ('symbol', drain_stream), ('day', drain_stream)]:
+        base = redis_conn.info('memory')['used_memory']
+        fill(redis_conn, store, events, symbols)
+        memory = redis_conn.info('memory')['used_memory'] - base
+
+        start = time.perf_counter()
+        num = drain(redis_conn)
+        cost = time.perf_counter() - start
+        redis_conn.flushdb()
+        print(
+            f'{store:>6}: {memory / 2 ** 20:.1f} MB, {memory / trade_num:.1f} B/trade, '
+            f'drain {num} trades in {cost:.2f}s, {num / cost:,.0f} trades/sec'
+        )
+
+if __name__ == '__main__':
+    main()
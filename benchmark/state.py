@@ -0,0 +1,93 @@
+'''Micro-benchmark of the per-event watcher state update.
+
+    python -m benchmark.state [event_num] [symbol_num]
+'''
+import random
+import sys
+import time
+
+from huobi.model.market.trade_detail import TradeDetail
+
+from symbol_state import BOOT_RATE, END_RATE, MIN_VOL, MAX_BUY_BACK_RATE, SymbolState, VectorState
+
+
+def legacy_update(info, data, interval=300):
+    detail = data[0]
+    now = detail.ts / 1000
+    last = now // interval
+    price = detail.price
+    vol = sum([each.price * each.amount for each in data])
+
+    if last > info['last']:
+        info['last'] = last
+        info['open_'] = data[-1].price
+        info['vol'] = vol
+        info['boot_price'] = info['open_'] * (1 + BOOT_RATE / 100)
+        info['end_price'] = info['open_'] * (1 + END_RATE / 100)
+        info['high'] = max(info['open_'], price)
+    else:
+        info['vol'] += vol
+        info['high'] = max(info['high'], price)
+        info['max_back'] = max(info['max_back'], 1 - price / info['high'])
+
+    return (
+        info['vol'] >= MIN_VOL
+        and info['max_back'] <= MAX_BUY_BACK_RATE
+        and info['boot_price'] < price < info['end_price']
+    )
+
+def create_events(event_num, symbol_num, start_ts=1620000000000):
+    events = []
+    price = [random.uniform(0.01, 5) for _ in range(symbol_num)]
+    for i in range(event_num):
+        index = random.randrange(symbol_num)
+        price[index] *= random.uniform(0.99, 1.012)
+        ts = start_ts + i
+        data = []
+        for _ in range(random.randint(1, 6)):
+            detail = TradeDetail()
+            detail.ts = ts
+            detail.price = price[index]
+            detail.amount = random.uniform(1, 5000)
+            detail.direction = 'buy'
+            data.append(detail)
+        events.append((index, data))
+    return events
+
+def run_legacy(events, symbol_num):
+    infos = [{
+        'last': 0, 'vol': 0, 'open_': 0, 'high': 0,
+        'boot_price': 0, 'end_price': 0, 'max_back': 0,
+    } for _ in range(symbol_num)]
+    start = time.perf_counter()
+    for index, data in events:
+        legacy_update(infos[index], data)
+    return time.perf_counter() - start
+
+def run_state(events, symbol_num):
+    states = [SymbolState(str(i)) for i in range(symbol_num)]
+    start = time.perf_counter()
+    for index, data in events:
+        states[index].update(data)
+    return time.perf_counter() - start
+
+def run_vector(events, symbol_num, batch=500):
+    state = VectorState([str(i) for i in range(symbol_num)])
+    start = time.perf_counter()
+    for i in range(0, len(events), batch):
+        for index, data in events[i:i+batch]:
+            state.push(index, data)
+        state.check(state.apply())
+    return time.perf_counter() - start
+
+def main():
+    event_num = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    symbol_num = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    events = create_events(event_num, symbol_num)
+
+    for name, func in [('dict', run_legacy), ('slots', run_state), ('vector', run_vector)]:
+        cost = min(func(events, symbol_num) for _ in range(5))
+        print(f'{name:>6}: {event_num / cost:,.0f} events/sec, {cost / event_num * 1e6:.3f} us/event')
+
+if __name__ == '__main__':
+    main()
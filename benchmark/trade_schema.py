@@ -0,0 +1,102 @@
+'''Query benchmark of the VARCHAR ms trade layout against the BIGINT us one.
+
+    python -m benchmark.trade_schema [row_num] [symbol_num]
+
+Both layouts are filled with the same synthetic day of trades in temporary
+tables, so it runs against any database without touching the real ones.
+'''
+import sys
+import time
+
+from dataset.pgsql import MS_IN_DAY, get_session
+
+DAY = 19000
+WINDOW_MS = 5 * 60 * 1000
+
+OLD_TABLE = '''
+CREATE TEMP TABLE bench_old (
+    id SERIAL PRIMARY KEY, symbol VARCHAR(10), ts VARCHAR(20),
+    price REAL, amount REAL, direction VARCHAR(5)
+)'''
+NEW_TABLE = '''
+CREATE TEMP TABLE bench_new (
+    id BIGSERIAL PRIMARY KEY, symbol VARCHAR(16), ts BIGINT, trade_id BIGINT,
+    price REAL, amount REAL, direction SMALLINT
+)'''
+FILL = '''
+INSERT INTO bench_{layout} (symbol, ts, price, amount, direction)
+SELECT
+    'sym' || (i % {symbol_num}) || 'usdt',
+    {ts},
+    random() * 10, random() * 1000,
+    {direction}
+FROM generate_series(0, {row_num} - 1) AS i'''
+OLD_TS = f"CAST({DAY * MS_IN_DAY} + i * {MS_IN_DAY} / {{row_num}} + (i % 7) / 1000.0 AS VARCHAR(20))"
+NEW_TS = f"({DAY * MS_IN_DAY} + i * {MS_IN_DAY} / {{row_num}}) * 1000 + i % 7"
+
+
+def queries(start, end):
+    return [
+        ('window', (
+            f"SELECT count(*) FROM bench_old WHERE symbol = 'sym1usdt' AND ts >= '{start}' AND ts <= '{end}'",
+            f"SELECT count(*) FROM bench_new WHERE symbol = 'sym1usdt' AND ts >= {start * 1000} AND ts <= {end * 1000}"
+        )),
+        ('all window', (
+            f"SELECT count(*) FROM bench_old WHERE ts >= '{start}' AND ts <= '{end}'",
+            f"SELECT count(*) FROM bench_new WHERE ts >= {start * 1000} AND ts <= {end * 1000}"
+        )),
+        ('min ts', (
+            "SELECT min(ts) FROM bench_old",
+            "SELECT min(ts) FROM bench_new"
+        )),
+        ('buy vol', (
+            f"SELECT sum(price * amount) FROM bench_old WHERE symbol = 'sym1usdt' AND direction = 'buy'",
+            f"SELECT sum(price * amount) FROM bench_new WHERE symbol = 'sym1usdt' AND direction = 0"
+        ))
+    ]
+
+def best_of(session, sql, repeat=5):
+    costs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = session.execute(sql).scalar()
+        costs.append(time.perf_counter() - start)
+    return min(costs), result
+
+def main():
+    row_num = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    symbol_num = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    with get_session() as session:
+        session.execute(OLD_TABLE)
+        session.execute(NEW_TABLE)
+        for layout, ts, direction in [
+            ('old', OLD_TS, "CASE WHEN i % 2 = 0 THEN 'buy' ELSE 'sell' END"),
+            ('new', NEW_TS, 'i % 2')
+        ]:
+            start = time.perf_counter()
+            session.execute(FILL.format(
+                layout=layout, symbol_num=symbol_num, row_num=row_num,
+                ts=ts.format(row_num=row_num), direction=direction
+            ))
+            print(f'fill {layout}: {time.perf_counter() - start:.2f}s')
+        session.execute('CREATE INDEX ON bench_new (symbol, ts)')
+        session.execute('ANALYZE bench_old')
+        session.execute('ANALYZE bench_new')
+
+        for layout in ['old', 'new']:
+            size = session.execute(f"SELECT pg_total_relation_size('bench_{layout}')").scalar()
+            print(f'size {layout}: {size / 2 ** 20:.1f} MB')
+
+        start = DAY * MS_IN_DAY + MS_IN_DAY // 2
+        for name, (old_sql, new_sql) in queries(start, start + WINDOW_MS):
+            old_cost, old_result = best_of(session, old_sql)
+            new_cost, new_result = best_of(session, new_sql)
+            print(
+                f'{name:>10}: old {old_cost * 1000:8.2f} ms, new {new_cost * 1000:8.2f} ms, '
+                f'x{old_cost / new_cost:.1f}, result {old_result} / {new_result}'
+            )
+        session.rollback()
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@ import time
 from openpyxl import Workbook
 from openpyxl.chart import LineChart, Reference
 from utils import ROOT
-from dataset.pgsql import get_session, get_Trade, Target
+from dataset.pgsql import get_session, Trade, Target
 
 DB_PATH = os.path.join(ROOT, 'test', 'db')
 
@@ -19,10 +19,9 @@ def add_sheet(wb, session, symbol, start, end):
     open_ = 0
     high = 0
     vol = 0
-    Trade = get_Trade(ts=start * 1000)
     data = Trade.get_data(session, symbol, start, end).all()
     for index, trade in enumerate(data):
-        time_ = round(float(trade.ts) / 1000 - start, 3)
+        time_ = round(trade.ts / 1e6 - start, 3)
         price = trade.price
         amount = trade.amount
         if index == 0:
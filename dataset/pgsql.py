@@ -1,4 +1,10 @@
-from sqlalchemy import Column, create_engine, VARCHAR, INTEGER, REAL, TEXT, func
+import io
+import os
+import threading
+import time
+
+from huobi.model.market.trade_detail import TradeDetail
+from sqlalchemy import BIGINT, Column, create_engine, event, Index, VARCHAR, INTEGER, REAL, SMALLINT, TEXT, TypeDecorator, func
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -9,91 +15,217 @@ PGPORT = config.getint('setting', 'PGPort')
 PGUSER = 'postgres'
 PGPASSWORD = user_config.get('setting', 'PGPassword')
 PGNAME = 'goodmorning'
+PG_POOL_SIZE = config.getint('setting', 'PGPoolSize')
 
 Base = declarative_base()
-TRADE_CLASS = {}
 MS_IN_DAY = 60*60*24*1000
+US_IN_DAY = MS_IN_DAY * 1000
+# days of partitions created ahead of today
+PARTITION_AHEAD = 3
+# days whose partition is committed, the pending ones live in session.info
+PARTITIONS = set()
+DIRECTIONS = ['buy', 'sell']
+
+
+class Direction(TypeDecorator):
+    '''Trade direction kept as the SMALLINT index of DIRECTIONS.'''
+    impl = SMALLINT
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else DIRECTIONS.index(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else DIRECTIONS[value]
+
+
+class Trade(Base):
+    '''Parent of the day partitions trade_{day}, rows are routed by ts.'''
+    __tablename__ = 'trade'
+    __table_args__ = (
+        Index('ix_trade_symbol_ts', 'symbol', 'ts'),
+        {'postgresql_partition_by': 'RANGE (ts)'}
+    )
+    # the partition key has to be part of the primary key
+    id = Column(BIGINT, primary_key=True, autoincrement=True)
+    # us, ms of the trade * 1000 + its index in the event
+    ts = Column(BIGINT, primary_key=True, autoincrement=False)
+    symbol = Column(VARCHAR(16))
+    trade_id = Column(BIGINT)
+    price = Column(REAL)
+    amount = Column(REAL)
+    direction = Column(Direction)
+
+    @staticmethod
+    def from_redis(key, value):
+        return get_trade_from_redis(key, value)
+
+    @staticmethod
+    def get_data(session, symbol, start, end):
+        data = session.query(Trade).filter(
+            Trade.symbol == symbol,
+            Trade.ts >= int(start * 1e6),
+            Trade.ts <= int(end * 1e6)
+        ).order_by(Trade.ts)
+        return data
 
-def create_Trade(day):
-    class Trade(Base):
-        __tablename__ = f'trade_{day}' if day else 'trade'
-        id = Column(INTEGER, primary_key=True)
-        symbol = Column(VARCHAR(10))
-        ts = Column(VARCHAR(20))
-        price = Column(REAL)
-        amount = Column(REAL)
-        direction = Column(VARCHAR(5))
-
-        @staticmethod
-        def from_redis(key, value):
-            key = key.decode('utf-8')
-            value = value.decode('utf-8')
-            _, symbol, _, num = key.split('_')
-            ts, price, amount, direction = value.split(',')
-            return Trade(
-                symbol=symbol,
-                ts=str(int(ts)+int(num)/1000),
-                price=float(price),
-                amount=float(amount),
-                direction = direction
-            )
-
-        @staticmethod
-        def get_data(session, symbol, start, end):
-            data = session.query(Trade).filter(
-                Trade.symbol == symbol,
-                Trade.ts >= str(start),
-                Trade.ts <= str(end)
-            ).order_by(Trade.ts)
-            return data
-
-        @staticmethod
-        def from_trade(trade):
-            return Trade(
-                symbol=trade.symbol,
-                ts=trade.ts,
-                price=trade.price,
-                amount=trade.amount,
-                direction=trade.direction
-            )
-
-    Base.metadata.create_all()
-    TRADE_CLASS[day] = Trade
-    return Trade
-
-def get_Trade(time):
-    day = get_day(time)
-
-    if day in TRADE_CLASS:
-        return TRADE_CLASS[day]
-    else:
-        return create_Trade(day)
 
 def get_day(time):
     if 0 <= time < 50000:
         return time
     elif 1e9 < time < 1e10:
-        return time * 1000 // MS_IN_DAY
+        return int(time * 1000 // MS_IN_DAY)
     elif 1e12 < time < 1e13:
-        return time // MS_IN_DAY
+        return int(time // MS_IN_DAY)
+    elif 1e15 < time < 1e16:
+        return int(time // US_IN_DAY)
 
-def get_trade_from_redis(key, value):
+def get_partitions(session: Session) -> 'list[int]':
+    return sorted(int(name.split('_')[1]) for name, in session.execute('''
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE pg_inherits.inhparent = 'trade'::regclass
+    '''))
+
+def ensure_partitions(session: Session, days):
+    '''Create the missing day partitions, the ones already seen are skipped.'''
+    pending = session.info.setdefault('partitions', set())
+    for day in sorted(set(days) - PARTITIONS - pending):
+        session.execute(
+            f'CREATE TABLE IF NOT EXISTS "trade_{day}" PARTITION OF trade '
+            f'FOR VALUES FROM ({day * US_IN_DAY}) TO ({(day + 1) * US_IN_DAY})'
+        )
+        pending.add(day)
+
+@event.listens_for(Session, 'after_commit')
+def commit_partitions(session: Session):
+    PARTITIONS.update(session.info.pop('partitions', ()))
+
+@event.listens_for(Session, 'after_transaction_end')
+def forget_partitions(session: Session, transaction):
+    # rolled back or closed, the next transaction has to create them again
+    if transaction.parent is None:
+        session.info.pop('partitions', None)
+
+def ensure_future_partitions(session: Session, ahead=PARTITION_AHEAD):
+    today = get_day(time.time())
+    ensure_partitions(session, range(today, today + ahead + 1))
+
+def drop_partitions(session: Session, keep_days) -> 'list[int]':
+    '''Retention, drop the day partitions older than keep_days.'''
+    before = get_day(time.time()) - keep_days
+    days = [day for day in get_partitions(session) if day < before]
+    for day in days:
+        session.execute(f'DROP TABLE "trade_{day}"')
+        PARTITIONS.discard(day)
+    return days
+
+def create_trade(symbol, ts, trade_id, price, amount, direction):
+    return Trade(
+        symbol=symbol,
+        ts=ts,
+        trade_id=trade_id,
+        price=price,
+        amount=amount,
+        direction=direction
+    )
+
+def parse_trade_from_redis(key, value) -> tuple:
+    '''(symbol, ts in us, trade id, price, amount, direction) of a trade key.'''
     key = key.decode('utf-8')
     value = value.decode('utf-8')
     _, symbol, _, num = key.split('_')
-    ts, price, amount, direction = value.split(',')
-    ts = int(ts)
-    num = int(num)
-    day = int(ts // MS_IN_DAY)
-    Trade = get_Trade(day)
+    ts, price, amount, direction, *trade_id = value.split(',')
+    return (
+        symbol, int(ts) * 1000 + int(num), int(trade_id[0]) if trade_id else None,
+        float(price), float(amount), direction
+    )
 
-    return Trade(
-        symbol=symbol,
-        ts=str(ts+num/1000),
-        price=float(price),
-        amount=float(amount),
-        direction = direction
+def parse_trade_from_stream(fields) -> tuple:
+    [(symbol, value)] = fields.items()
+    symbol = symbol.decode('utf-8')
+    ts, price, amount, direction, num, *trade_id = value.decode('utf-8').split(',')
+    return (
+        symbol, int(ts) * 1000 + int(num), int(trade_id[0]) if trade_id else None,
+        float(price), float(amount), direction
+    )
+
+def get_trade_from_redis(key, value):
+    return create_trade(*parse_trade_from_redis(key, value))
+
+def get_trade_from_stream(fields):
+    return create_trade(*parse_trade_from_stream(fields))
+
+
+class TradeCopier:
+    '''Buffer parsed trades and write them with COPY FROM STDIN into the
+    partitioned trade table inside the transaction of the session, nothing
+    is visible before commit.'''
+    columns = ('symbol', 'ts', 'trade_id', 'price', 'amount', 'direction')
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.buffer = io.StringIO()
+        self.days = set()
+        self.size = 0
+        self.total = 0
+
+    def add(self, trade: tuple):
+        symbol, ts, trade_id, price, amount, direction = trade
+        self.days.add(ts // US_IN_DAY)
+        trade_id = r'\N' if trade_id is None else trade_id
+        self.buffer.write(f'{symbol}\t{ts}\t{trade_id}\t{price}\t{amount}\t{DIRECTIONS.index(direction)}\n')
+        self.size += 1
+
+    def flush(self) -> int:
+        if not self.size:
+            return 0
+
+        ensure_partitions(self.session, self.days)
+        self.buffer.seek(0)
+        cursor = self.session.connection().connection.cursor()
+        cursor.copy_expert(f'COPY trade ({", ".join(self.columns)}) FROM STDIN', self.buffer)
+        cursor.close()
+
+        size = self.size
+        self.total += size
+        self.buffer = io.StringIO()
+        self.days = set()
+        self.size = 0
+        return size
+
+
+def iter_events(session, start, end, symbols=None, chunk=5000):
+    query = session.query(
+        Trade.symbol, Trade.ts, Trade.trade_id, Trade.price, Trade.amount, Trade.direction
+    ).filter(
+        Trade.ts >= int(start * 1e6),
+        Trade.ts <= int(end * 1e6)
     )
+    if symbols:
+        query = query.filter(Trade.symbol.in_(symbols))
+
+    last = None
+    pending: 'dict[str, list[TradeDetail]]' = {}
+    for symbol, ts, trade_id, price, amount, direction in query.order_by(Trade.ts).yield_per(chunk):
+        ms = ts // 1000
+        if ms != last:
+            for pending_symbol, data in pending.items():
+                yield pending_symbol, last, data
+            pending = {}
+            last = ms
+
+        detail = TradeDetail()
+        detail.ts = ms
+        detail.tradeId = trade_id
+        detail.price = price
+        detail.amount = amount
+        detail.direction = direction
+        pending.setdefault(symbol, []).insert(0, detail)
+
+    for pending_symbol, data in pending.items():
+        yield pending_symbol, last, data
+
 
 class Target(Base):
     __tablename__ = 'target'
@@ -167,9 +299,45 @@ class Message(Base):
     msg_type = Column(INTEGER)
     uids = Column(VARCHAR(200))
 
-def get_session(host=PGHOST, port=PGPORT, db=PGNAME, user=PGUSER, password=PGPASSWORD) -> Session:
-    engine = create_engine(f'postgresql://{user}:{password}@{host}:{port}/{db}')
-    Session = sessionmaker(bind=engine)
-    Base.metadata.bind=engine
-    Base.metadata.create_all()
-    return Session()
+class Database:
+    '''One engine, so one connection pool, and session factory per process,
+    created on first use and again in a forked child.'''
+    def __init__(self, host=PGHOST, port=PGPORT, db=PGNAME, user=PGUSER, password=PGPASSWORD):
+        self.url = f'postgresql://{user}:{password}@{host}:{port}/{db}'
+        self.engine = None
+        self.session_factory = None
+        self.pid = None
+        self.inherited = []
+        self.lock = threading.Lock()
+
+    def get_engine(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                if self.engine:
+                    # connections of the parent process must not be reused, nor closed,
+                    # the sockets are still in use there. Kept so gc never closes them.
+                    self.inherited.append(self.engine)
+                self.engine = create_engine(
+                    self.url, pool_size=PG_POOL_SIZE, max_overflow=PG_POOL_SIZE,
+                    pool_pre_ping=True, pool_recycle=3600
+                )
+                self.session_factory = sessionmaker(bind=self.engine)
+                self.pid = os.getpid()
+            return self.engine
+
+    def session(self) -> Session:
+        self.get_engine()
+        return self.session_factory()
+
+    def init(self):
+        '''Create the missing tables and the coming trade partitions.'''
+        Base.metadata.create_all(self.get_engine())
+        with self.session() as session:
+            ensure_future_partitions(session)
+            session.commit()
+
+
+DATABASE = Database()
+
+def get_session() -> Session:
+    return DATABASE.session()
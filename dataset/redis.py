@@ -1,10 +1,20 @@
+import queue
+import threading
 import redis
 import time
-from utils import config, user_config
+from utils import config, user_config, logger
 
 RHOST = config.get('setting', 'RHost')
 RPORT = config.getint('setting', 'RPort')
 RPASSWORD = user_config.get('setting', 'RPassword')
+TRADE_STORE = config.get('setting', 'TradeStore')
+MS_IN_DAY = 60*60*24*1000
+
+TRADE_BATCH_SIZE = 500
+TRADE_FLUSH_INTERVAL = 0.2
+TRADE_QUEUE_SIZE = 20000
+TRADE_PUT_TIMEOUT = 0.005
+TRADE_FLUSH_RETRY = 3
 
 class Redis(redis.StrictRedis):
     def __init__(self, host=RHOST, port=RPORT,
@@ -39,15 +49,41 @@ class Redis(redis.StrictRedis):
         cursor = '0'
         while cursor != 0:
             cursor, keys = self.scan(cursor, match, count)
-            values = self.mget(keys)
-            if keys and values:
-                yield keys, values
+            if keys:
+                yield keys, self.mget(keys)
 
-    def write_trade(self, symbol: str, data):
-        self.mset({
-            f'trade_{symbol}_{each.ts}_{i}' : f'{each.ts},{each.price},{each.amount},{each.direction}'
+    @staticmethod
+    def trade_mapping(symbol: str, data):
+        return {
+            f'trade_{symbol}_{each.ts}_{i}' : f'{each.ts},{each.price},{each.amount},{each.direction},{each.tradeId}'
             for i, each in enumerate(reversed(data))
-        })
+        }
+
+    @staticmethod
+    def trade_stream(symbol: str, ts: int, store=TRADE_STORE):
+        if store == 'day':
+            return f'stream_{ts // MS_IN_DAY}'
+        return f'stream_{symbol}'
+
+    def write_trade(self, symbol: str, data, pipeline=None, store=TRADE_STORE):
+        conn = pipeline or self
+        if store == 'key':
+            conn.mset(self.trade_mapping(symbol, data))
+            return
+
+        for i, each in enumerate(reversed(data)):
+            conn.xadd(
+                self.trade_stream(symbol, each.ts, store),
+                {symbol: f'{each.ts},{each.price},{each.amount},{each.direction},{i},{each.tradeId}'}
+            )
+
+    @staticmethod
+    def next_id(last_id):
+        ms, seq = last_id.decode('utf-8').split('-')
+        return f'{ms}-{int(seq)+1}'
+
+    def trim_stream(self, name, last_id):
+        return self.execute_command('XTRIM', name, 'MINID', self.next_id(last_id))
 
     def write_target(self, symbol):
         now_str = time.strftime('%Y-%m-%d-%H', time.localtime())
@@ -59,3 +95,66 @@ class Redis(redis.StrictRedis):
             self.set(name, symbol)
         elif symbol not in targets:
             self.set(name, ','.join([targets, symbol]))
+
+
+class TradeWriter(threading.Thread):
+    def __init__(self, redis_conn: Redis, batch_size=TRADE_BATCH_SIZE,
+                flush_interval=TRADE_FLUSH_INTERVAL, queue_size=TRADE_QUEUE_SIZE,
+                put_timeout=TRADE_PUT_TIMEOUT):
+        super().__init__(name='TradeWriter', daemon=True)
+        self.redis_conn = redis_conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.dropped = 0
+        self.start()
+
+    def write_trade(self, symbol: str, data):
+        try:
+            self.queue.put((symbol, data), timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f'Trade queue is full, {self.dropped} events dropped')
+
+    def get_batch(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0 and not self.stopped.is_set():
+                break
+
+            try:
+                batch.append(self.queue.get(timeout=max(timeout, 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch, retry=TRADE_FLUSH_RETRY):
+        for attempt in range(retry + 1):
+            pipeline = self.redis_conn.pipeline(transaction=False)
+            for symbol, data in batch:
+                self.redis_conn.write_trade(symbol, data, pipeline)
+
+            try:
+                pipeline.execute()
+                return
+            except redis.RedisError as e:
+                if attempt == retry:
+                    logger.error(f'Fail to write {len(batch)} trade events, drop them, {e}')
+                else:
+                    logger.warning(f'Fail to write {len(batch)} trade events, retry {attempt + 1}, {e}')
+                    time.sleep(self.flush_interval * (attempt + 1))
+
+    def run(self):
+        while not self.stopped.is_set() or not self.queue.empty():
+            batch = self.get_batch()
+            if batch:
+                self.flush(batch)
+
+    def close(self, timeout=10):
+        self.stopped.set()
+        self.join(timeout)
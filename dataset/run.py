@@ -1,15 +1,90 @@
 from dataset.redis import Redis
-from dataset.pgsql import get_Trade, get_session, Session, Target, get_trade_from_redis, get_day, MS_IN_DAY
-from sqlalchemy import func, inspect
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from dataset.pgsql import (DATABASE, Base, get_session, Session, Target, TradeCopier, parse_trade_from_redis,
+                           parse_trade_from_stream, get_partitions, ensure_partitions, ensure_future_partitions,
+                           drop_partitions, PG_POOL_SIZE, US_IN_DAY)
+from sqlalchemy import inspect
+import re
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+COPY_BATCH = 50000
+DELETE_BATCH = 1000
+# plain tables left by the partition migration, relocated into the partitions
+LEFTOVER_TABLES = ['trade_stray', 'trade_legacy']
+
+def report_speed(name, num, start):
+    cost = time.time() - start
+    print(f'{name}: {num} trades in {cost:.1f}s, {num / cost if cost else 0:,.0f} rows/sec')
+
+def write_trade(redis_conn: Redis, session: Session, batch=COPY_BATCH):
+    start = time.time()
+    copier = TradeCopier(session)
+    drained_keys = []
+
+    def commit():
+        copier.flush()
+        session.commit()
+        # keys are only removed from redis once the rows are committed
+        for i in range(0, len(drained_keys), DELETE_BATCH):
+            redis_conn.delete(*drained_keys[i:i+DELETE_BATCH])
+        drained_keys.clear()
 
-def write_trade(redis_conn: Redis, session: Session):
     for keys, values in redis_conn.scan_iter_with_data('trade_*', 500):
-        trades = [get_trade_from_redis(key, value) for key, value in zip(keys, values)]
-        session.add_all(trades)
+        for key, value in zip(keys, values):
+            if value is not None:
+                copier.add(parse_trade_from_redis(key, value))
+        drained_keys.extend(keys)
+        if copier.size >= batch:
+            commit()
+
+    commit()
+    report_speed('trade keys', copier.total, start)
+
+def write_trade_stream(redis_conn: Redis, session: Session, count=5000, batch=COPY_BATCH):
+    start = time.time()
+    copier = TradeCopier(session)
+    drained_ids: 'dict[bytes, bytes]' = {}
+
+    def commit():
+        copier.flush()
         session.commit()
-        redis_conn.delete(*keys)
+        for name, last_id in drained_ids.items():
+            redis_conn.trim_stream(name, last_id)
+        drained_ids.clear()
+
+    for name in redis_conn.scan_iter('stream_*', 100):
+        min_id = '-'
+        while True:
+            entries = redis_conn.xrange(name, min=min_id, count=count)
+            if not entries:
+                break
+
+            for _, fields in entries:
+                copier.add(parse_trade_from_stream(fields))
+            drained_ids[name] = entries[-1][0]
+            min_id = redis_conn.next_id(entries[-1][0])
+            if copier.size >= batch:
+                commit()
+
+    commit()
+    report_speed('trade streams', copier.total, start)
+
+def migrate_trade(redis_conn: Redis, store='symbol'):
+    for keys, values in redis_conn.scan_iter_with_data('trade_*', 500):
+        pipeline = redis_conn.pipeline(transaction=False)
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+
+            _, symbol, ts, num = key.decode('utf-8').split('_')
+            ts_, price, amount, direction, *trade_id = value.decode('utf-8').split(',')
+            pipeline.xadd(
+                redis_conn.trade_stream(symbol, int(ts), store),
+                {symbol: ','.join([ts_, price, amount, direction, num, *trade_id])}
+            )
+        pipeline.delete(*keys)
+        pipeline.execute()
 
 def write_target(redis_conn: Redis, session: Session):
     keys = redis_conn.keys('target_*')
@@ -23,19 +98,18 @@ def write_target(redis_conn: Redis, session: Session):
 def trans():
     redis_conn = Redis()
     with get_session() as session:
+        ensure_future_partitions(session)
+        session.commit()
         write_target(redis_conn, session)
         write_trade(redis_conn, session)
+        write_trade_stream(redis_conn, session)
 
 
 def vacuum(session: Session=None, table: str='', full=True):
     def _vacuum():
-        engine = session.bind
-        connection = engine.raw_connection() 
-        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT) 
-        cursor = connection.cursor() 
-        cursor.execute(f"VACUUM {'FULL' if full else ''} {table}")
-        cursor.close()
-        connection.close()
+        # the pool resets the isolation level when the connection is returned
+        with session.bind.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(f"VACUUM {'FULL' if full else ''} {table}")
     
     if session:
         _vacuum()
@@ -43,55 +117,159 @@ def vacuum(session: Session=None, table: str='', full=True):
         with get_session() as session:
             _vacuum()
 
-def delete_many(session: Session, table:str, ids: 'list[int]'):
-    ids_str = ','.join(ids)
-    sql = f'DELETE FROM {table} WHERE id IN ({ids_str})'
-    session.execute(sql)
+def get_trade_tables(session: Session) -> 'list[str]':
+    inspector = inspect(session.bind)
+    return [name for name in inspector.get_table_names() if name == 'trade' or name.startswith('trade_')]
 
-def move_trade(Trade, session, start_day, end_day):
-    for day in range(start_day, end_day):
-        print(day)
-        DayTrade = get_Trade(day)
-        start = str(day * MS_IN_DAY)
-        end = str((day + 1) * MS_IN_DAY)
+def is_partitioned(session: Session, table: str) -> bool:
+    return bool(session.execute(
+        f"SELECT 1 FROM pg_partitioned_table WHERE partrelid = '{table}'::regclass"
+    ).scalar())
 
-        while True:
-            trades = session.query(Trade).filter(Trade.ts >= start, Trade.ts < end).limit(1000).all()
-            print(len(trades))
-            if not trades:
-                break
+def relocate_day(table: str, day: int) -> int:
+    '''Move the rows of one day from a plain table into the partitioned trade
+    table with a single statement, committed on its own.'''
+    columns = ', '.join(TradeCopier.columns)
+    with get_session() as session:
+        rows = session.execute(f'''
+            WITH moved AS (
+                DELETE FROM "{table}" WHERE ts >= {day * US_IN_DAY} AND ts < {(day + 1) * US_IN_DAY}
+                RETURNING {columns}
+            )
+            INSERT INTO trade ({columns}) SELECT {columns} FROM moved
+        ''').rowcount
+        session.commit()
+        return rows
+
+def relocate_trades(table: str, workers=1):
+    '''Route every row of a plain trade table into its day partition, day by
+    day, optionally several days at once, and drop the emptied table.'''
+    start = time.time()
+    workers = min(workers, 2 * PG_POOL_SIZE)
+    with get_session() as session:
+        days = dict(session.execute(f'SELECT ts / {US_IN_DAY}, count(*) FROM "{table}" GROUP BY 1 ORDER BY 1').fetchall())
+        ensure_partitions(session, days)
+        # one scan to build it, then every day is an index range instead of a scan
+        session.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_ts" ON "{table}" (ts)')
+        session.commit()
 
-            new_trades = [DayTrade.from_trade(trade) for trade in trades]
-            session.bulk_save_objects(new_trades)
-            delete_many(session, Trade.__tablename__, [str(trade.id) for trade in trades])
+    total = sum(days.values())
+    done = 0
+    print(f'{table}: {total} rows of {len(days)} days to relocate')
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(relocate_day, table, day): day for day in days}
+        for i, future in enumerate(as_completed(futures), 1):
+            done += future.result()
+            cost = time.time() - start
+            print(
+                f'[{i}/{len(days)}] day {futures[future]}: {days[futures[future]]} rows, '
+                f'{done}/{total} in {cost:.1f}s, {done / cost if cost else 0:,.0f} rows/sec'
+            )
+
+    with get_session() as session:
+        if not session.execute(f'SELECT 1 FROM "{table}" LIMIT 1').scalar():
+            session.execute(f'DROP TABLE "{table}"')
             session.commit()
-    
-    vacuum(session, Trade.__tablename__, False)
 
-def check_trade_tables():
+def relocate_leftovers(workers=1):
+    with get_session() as session:
+        tables = get_trade_tables(session)
+
+    for table in LEFTOVER_TABLES:
+        if table in tables:
+            relocate_trades(table, workers)
+
+def check_trade_tables(workers=1):
+    '''Relocate the rows left in plain trade tables and list the partitions.'''
+    relocate_leftovers(workers)
+    with get_session() as session:
+        partitions = get_partitions(session)
+        unattached = [
+            table for table in get_trade_tables(session)
+            if re.fullmatch(r'trade_\d+', table) and int(table.split('_')[1]) not in partitions
+        ]
+        if unattached:
+            print(f'Not partitions yet, run partition first: {", ".join(unattached)}')
+
+        for day in partitions:
+            rows = session.execute(f"SELECT reltuples FROM pg_class WHERE relname = 'trade_{day}'").scalar()
+            print(day, f'~{int(rows)} rows')
+
+def migrate_trade_schema():
+    '''Convert trade tables of the VARCHAR ms layout in place, ts becomes
+    BIGINT us, direction a SMALLINT, plus trade_id and a (symbol, ts) index.'''
+    with get_session() as session:
+        for table in get_trade_tables(session):
+            columns = [column['name'] for column in inspect(session.bind).get_columns(table)]
+            if 'trade_id' in columns:
+                continue
+
+            start = time.time()
+            session.execute(f'''
+                ALTER TABLE "{table}"
+                    ALTER COLUMN id TYPE BIGINT,
+                    ALTER COLUMN symbol TYPE VARCHAR(16),
+                    ALTER COLUMN ts TYPE BIGINT USING CAST(ROUND(CAST(ts AS NUMERIC) * 1000) AS BIGINT),
+                    ALTER COLUMN direction TYPE SMALLINT USING CASE direction WHEN 'buy' THEN 0 WHEN 'sell' THEN 1 END,
+                    ADD COLUMN trade_id BIGINT
+            ''')
+            session.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_symbol_ts" ON "{table}" (symbol, ts)')
+            session.execute(f'ANALYZE "{table}"')
+            session.commit()
+            print(f'{table} migrated in {time.time() - start:.1f}s')
+
+def migrate_trade_partitions(workers=1):
+    '''Attach the plain trade_{day} tables to the partitioned trade table,
+    rows out of the day of their table and the ones of the old plain trade
+    table are inserted again through the parent, which routes them.'''
+    migrate_trade_schema()
     with get_session() as session:
-        inspector = inspect(session.bind)
-        tables = [name for name in inspector.get_table_names() if name.startswith('trade')]
-        print(tables)
+        tables = get_trade_tables(session)
+        if 'trade' in tables and not is_partitioned(session, 'trade'):
+            session.execute('ALTER TABLE trade RENAME TO trade_legacy')
+            session.execute('ALTER TABLE trade_legacy RENAME CONSTRAINT trade_pkey TO trade_legacy_pkey')
+            session.execute('ALTER INDEX IF EXISTS ix_trade_symbol_ts RENAME TO ix_trade_legacy_symbol_ts')
+            session.execute('ALTER SEQUENCE IF EXISTS trade_id_seq RENAME TO trade_legacy_id_seq')
+            session.commit()
+            tables.append('trade_legacy')
+
+        Base.metadata.create_all(session.bind)
+
+        columns = ', '.join(TradeCopier.columns)
+        partitions = get_partitions(session)
+        session.execute('CREATE TABLE IF NOT EXISTS trade_stray (LIKE trade)')
         for table in tables:
+            if not re.fullmatch(r'trade_\d+', table) or int(table.split('_')[1]) in partitions:
+                continue
+
+            start = time.time()
             day = int(table.split('_')[1])
-            Trade = get_Trade(day)
-            print(day, Trade.__tablename__)
-            min_ts = float(session.query(func.min(Trade.ts)).scalar())
-            print(min_ts)
-            if min_ts < day * MS_IN_DAY:
-                print('move small')
-                min_day = int(min_ts // MS_IN_DAY)
-                move_trade(Trade, session, min_day, day)
-
-            max_ts = float(session.query(func.max(Trade.ts)).scalar())
-            print(max_ts)
-            if max_ts > (day + 1) * MS_IN_DAY:
-                print('move big')
-                max_day = int(max_ts // MS_IN_DAY)
-                move_trade(Trade, session, day+1, max_day+1)
-
-        vacuum(session)
+            low, high = day * US_IN_DAY, (day + 1) * US_IN_DAY
+            stray = session.execute(f'''
+                WITH moved AS (
+                    DELETE FROM "{table}" WHERE ts < {low} OR ts >= {high} RETURNING id, {columns}
+                )
+                INSERT INTO trade_stray (id, {columns}) SELECT id, {columns} FROM moved
+            ''').rowcount
+            session.execute(f'''
+                ALTER TABLE "{table}"
+                    DROP CONSTRAINT IF EXISTS "{table}_pkey",
+                    ADD CONSTRAINT "{table}_pkey" PRIMARY KEY (id, ts)
+            ''')
+            session.execute(f'ALTER TABLE trade ATTACH PARTITION "{table}" FOR VALUES FROM ({low}) TO ({high})')
+            session.commit()
+            print(f'{table} attached in {time.time() - start:.1f}s, {stray} rows out of its day')
+
+        ensure_future_partitions(session)
+        session.commit()
+
+    relocate_leftovers(workers)
+
+def drop_old_partitions(keep_days):
+    with get_session() as session:
+        days = drop_partitions(session, keep_days)
+        session.commit()
+        print(f'Drop partitions of {days}')
 
 def main():
     if len(sys.argv) > 1:
@@ -102,7 +280,20 @@ def main():
             table = sys.argv[2] if len(sys.argv) > 2 else ''
             vacuum(table=table)
         elif arg == 'check':
-            check_trade_tables()
+            workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+            check_trade_tables(workers)
+        elif arg == 'init':
+            DATABASE.init()
+        elif arg == 'schema':
+            migrate_trade_schema()
+        elif arg == 'partition':
+            workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+            migrate_trade_partitions(workers)
+        elif arg == 'retain':
+            drop_old_partitions(int(sys.argv[2]))
+        elif arg == 'migrate':
+            store = sys.argv[2] if len(sys.argv) > 2 else 'symbol'
+            migrate_trade(Redis(), store)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
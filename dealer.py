@@ -1,9 +1,12 @@
+import sys
 import time
 
-from wampyapp import DealerClient as Client, State
+from wampyapp import DealerClient as Client, MultiDealerClient, State
 from utils.parallel import run_process
-from utils import config, kill_all_threads, logger, user_config
-from apscheduler.schedulers.gevent import GeventScheduler as Scheduler
+from utils import config, get_target_time, kill_all_threads, logger, user_config
+from utils.clock import CLOCK
+from utils.connection import ADAPTER, POOL_SIZE
+from utils.metrics import LATENCY
 from market import MarketClient
 from retry import retry
 from user import User
@@ -37,16 +40,43 @@ def init_dealer(user) -> Client:
     client.start()
     return client
 
+@retry(tries=5, delay=1, logger=logger)
+def init_multi_dealer(users) -> MultiDealerClient:
+    market_client = MarketClient()
+    client = MultiDealerClient(market_client, users)
+    client.start()
+    return client
+
+def add_symbols(users: 'list[User]', symbols):
+    '''Arm and stream the orders of symbols found after start.'''
+    for user in users:
+        user.arm(symbols)
+        user.sub_order_stream(symbols)
+
+def wait_target_time(client: Client):
+    # the watcher only sends the target time 30s ahead, too late to rebuild idle connections
+    ADAPTER.keep_warm(get_target_time(CLOCK.now()))
+    client.wait_state(State.RUNNING)
+    while not client.target_time:
+        time.sleep(0.1)
+
+    ADAPTER.keep_warm(client.target_time)
+    client.delayed_tasks.call_later(
+        client.target_time + SECOND_SELL_AFTER - CLOCK.now(),
+        client.high_sell_handler, '', 0
+    )
+
 def main(user: User):
     logger.info('Start run sub process')
+    CLOCK.start()
     client = init_dealer(user)
+    user.arm(client.market_client.symbols_info.keys())
+    user.start_stream(list(client.market_client.symbols_info.keys()))
+    client.market_client.reconcile(lambda new_symbols, _: add_symbols([user], new_symbols))
 
-    scheduler = Scheduler()
-    scheduler.add_job(client.high_sell_handler, args=['', 0], trigger='cron', hour=0, minute=0, second=int(SECOND_SELL_AFTER))
-    scheduler.start()
-
-    client.wait_state(State.RUNNING)
+    wait_target_time(client)
     client.wait_state(State.STARTED)
+    LATENCY.dump(logger)
     client.stop()
     logger.info('Time to cancel')
     user.cancel_and_sell(client.targets.values())
@@ -54,9 +84,33 @@ def main(user: User):
     user.report()
     kill_all_threads()
 
+def multi_main(users: 'list[User]'):
+    logger.info(f'Start run multi dealer for {len(users)} users')
+    CLOCK.start()
+    client = init_multi_dealer(users)
+    ADAPTER.resize(POOL_SIZE * len(users))
+    symbols = list(client.market_client.symbols_info.keys())
+    for user in users:
+        user.arm(symbols)
+        user.start_stream(symbols)
+    client.market_client.reconcile(lambda new_symbols, _: add_symbols(users, new_symbols))
+
+    wait_target_time(client)
+    client.wait_state(State.STARTED)
+    LATENCY.dump(logger)
+    client.stop()
+    logger.info('Time to cancel')
+    client.cancel_and_sell()
+    time.sleep(2)
+    client.fan_out(lambda user: user.report(), users)
+    kill_all_threads()
+
 
 if __name__ == '__main__':
     logger.info('Dealer')
     users = init_users()
     # time.sleep(20)
-    run_process([(main, (user,), user.username) for user in users], is_lock=True, limit_num=len(users)+2)
+    if len(sys.argv) > 1 and sys.argv[1] == 'multi':
+        multi_main(users)
+    else:
+        run_process([(main, (user,), user.username) for user in users], is_lock=True, limit_num=len(users)+2)
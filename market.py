@@ -1,11 +1,140 @@
+import mmap
+import os
+import pickle
+import threading
 import time
 import re
+from collections.abc import Mapping
+
+import numpy as np
 
 from huobi.client.generic import GenericClient
 from huobi.client.market import MarketClient as _MarketClient
 from huobi.model.generic.symbol import Symbol
 
-from utils import timeout_handle
+from utils import ROOT, config, logger, timeout_handle
+
+SYMBOL_CACHE_PATH = os.path.join(ROOT, 'cache', 'symbols.pkl')
+SYMBOL_CACHE_TTL = config.getint('setting', 'SymbolCacheTTL')
+MARKET_SNAPSHOT_PATH = os.path.join(ROOT, 'cache', 'market.snap')
+SNAPSHOT_MAX_AGE = config.getint('setting', 'SnapshotMaxAge')
+SNAPSHOT_CHECK_INTERVAL = config.getint('setting', 'SnapshotCheckInterval')
+
+
+class MarketSnapshot:
+    '''Columnar symbols info and mark price of the master watcher in a file.
+
+    Every publish writes a new file and renames it over the old one, readers
+    map it read only and swap to the new mapping once the file changed, so a
+    mapped table is never modified.'''
+    header_dtype = np.dtype([('time', 'f8'), ('count', 'i8')])
+    dtype = np.dtype([
+        ('symbol', 'S24'),
+        ('base_currency', 'S16'),
+        ('price_precision', 'i1'),
+        ('amount_precision', 'i1'),
+        ('value_precision', 'i1'),
+        ('min_order_amt', 'f8'),
+        ('max_order_amt', 'f8'),
+        ('min_order_value', 'f8'),
+        ('limit_order_min_order_amt', 'f8'),
+        ('sell_market_min_order_amt', 'f8'),
+        ('price', 'f8')
+    ])
+
+    def __init__(self, path=MARKET_SNAPSHOT_PATH):
+        self.path = path
+        self.stat = None
+        self.time = 0
+        # table, index by symbol and the decoded infos of one mapped file
+        self.view = (np.zeros(0, self.dtype), {}, {})
+
+    @classmethod
+    def publish(cls, symbols_info: 'dict[str, Symbol]', mark_price: 'dict[str, float]', info_time, path=MARKET_SNAPSHOT_PATH):
+        table = np.zeros(len(symbols_info), cls.dtype)
+        for row, (symbol, info) in zip(table, symbols_info.items()):
+            row['symbol'] = symbol
+            row['base_currency'] = info.base_currency
+            row['price'] = mark_price.get(symbol, 0)
+            for name in cls.dtype.names[2:-1]:
+                row[name] = getattr(info, name) or 0
+
+        header = np.array([(info_time, len(table))], cls.header_dtype)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}'
+            with open(tmp_path, 'wb') as f:
+                f.write(header.tobytes())
+                f.write(table.tobytes())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f'Fail to publish market snapshot, {e}')
+
+    def load(self) -> bool:
+        '''Map the snapshot file again if it changed, return whether it did.'''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+
+        stat = (stat.st_ino, stat.st_mtime_ns)
+        if stat == self.stat:
+            return False
+
+        with open(self.path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.frombuffer(buffer, self.header_dtype, 1)[0]
+        table = np.frombuffer(buffer, self.dtype, int(header['count']), self.header_dtype.itemsize)
+        index = {symbol.decode(): i for i, symbol in enumerate(table['symbol'])}
+        self.view = (table, index, {})
+        self.time = float(header['time'])
+        self.stat = stat
+        return True
+
+    @property
+    def age(self):
+        return time.time() - self.time
+
+    def symbols(self) -> 'list[str]':
+        return list(self.view[1])
+
+    def info(self, symbol) -> Symbol:
+        table, index, infos = self.view
+        if symbol in infos:
+            return infos[symbol]
+
+        row = table[index[symbol]]
+        info = Symbol()
+        info.symbol = symbol
+        info.base_currency = row['base_currency'].decode()
+        info.quote_currency = 'usdt'
+        for name in self.dtype.names[2:-1]:
+            setattr(info, name, row[name].item())
+        infos[symbol] = info
+        return info
+
+    def price(self, symbol) -> float:
+        table, index, _ = self.view
+        return float(table['price'][index[symbol]])
+
+
+class SnapshotView(Mapping):
+    '''Read only dict like view of one column of a market snapshot.'''
+    def __init__(self, snapshot: MarketSnapshot, getter):
+        self.snapshot = snapshot
+        self.getter = getter
+
+    def __getitem__(self, symbol):
+        return self.getter(symbol)
+
+    def __contains__(self, symbol):
+        return symbol in self.snapshot.view[1]
+
+    def __iter__(self):
+        return iter(self.snapshot.symbols())
+
+    def __len__(self):
+        return len(self.snapshot.view[1])
 
 
 class MarketClient(_MarketClient):
@@ -15,12 +144,144 @@ class MarketClient(_MarketClient):
         'yamv2usdt', 'bttusdt', 'dogeusdt'
     ]
 
-    def __init__(self, **kwargs):
+    def __init__(
+        self, cache_path=SYMBOL_CACHE_PATH, cache_ttl=SYMBOL_CACHE_TTL,
+        snapshot_path=MARKET_SNAPSHOT_PATH, publisher=False, **kwargs
+    ):
         super().__init__(**kwargs)
         self.generic_client = GenericClient()
         self.symbols_info: 'dict[str, Symbol]' = {}
         self.mark_price: 'dict[str, float]' = {}
-        self.update_symbols_info()
+        self.info_time = 0
+        self.cache_path = cache_path
+        self.snapshot = MarketSnapshot(snapshot_path)
+        self.publisher = publisher
+        self.from_snapshot = not publisher and self.load_snapshot()
+        self.from_cache = self.from_snapshot or self.load_cache(cache_ttl)
+        if not self.from_cache:
+            self.update_symbols_info()
+        elif publisher:
+            self.publish_snapshot()
+
+    def load_snapshot(self) -> bool:
+        '''Follow the snapshot of the master watcher if it is fresh.'''
+        try:
+            self.snapshot.load()
+        except Exception as e:
+            logger.error(f'Fail to load market snapshot, {e}')
+            return False
+
+        if self.snapshot.age > SNAPSHOT_MAX_AGE:
+            return False
+
+        self.symbols_info = SnapshotView(self.snapshot, self.snapshot.info)
+        self.mark_price = SnapshotView(self.snapshot, self.snapshot.price)
+        self.info_time = self.snapshot.time
+        logger.info(f'Follow market snapshot of {len(self.symbols_info)} symbols')
+        return True
+
+    def publish_snapshot(self):
+        MarketSnapshot.publish(self.symbols_info, self.mark_price, self.info_time, self.snapshot.path)
+
+    def load_cache(self, ttl) -> bool:
+        '''Start from the cached symbols info if it is younger than ttl seconds.'''
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            logger.error(f'Fail to load symbols cache, {e}')
+            return False
+
+        age = time.time() - cache['time']
+        if age > ttl:
+            return False
+
+        self.symbols_info = cache['symbols_info']
+        self.mark_price = cache['mark_price']
+        self.info_time = cache['time']
+        logger.info(f'Load {len(self.symbols_info)} symbols from cache of {age:.0f}s ago')
+        return True
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f'{self.cache_path}.{os.getpid()}'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({
+                    'time': self.info_time,
+                    'symbols_info': self.symbols_info,
+                    'mark_price': self.mark_price
+                }, f)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.error(f'Fail to save symbols cache, {e}')
+
+    def follow_snapshot(self, callback=None, interval=SNAPSHOT_CHECK_INTERVAL):
+        '''Pick up every new snapshot, fall back to REST once it gets stale.'''
+        # symbols last reported to the callback
+        symbols = set(self.symbols_info)
+        while self.from_snapshot:
+            time.sleep(interval)
+            try:
+                self.snapshot.load()
+            except Exception as e:
+                logger.error(f'Fail to load market snapshot, {e}')
+
+            if self.snapshot.age > SNAPSHOT_MAX_AGE:
+                logger.warning('Market snapshot is stale, refresh symbols by REST')
+                if isinstance(self.symbols_info, SnapshotView):
+                    snapshot_symbols = self.snapshot.symbols()
+                    self.symbols_info = {symbol: self.snapshot.info(symbol) for symbol in snapshot_symbols}
+                    self.mark_price = {symbol: self.snapshot.price(symbol) for symbol in snapshot_symbols}
+                try:
+                    self.update_symbols_info()
+                except Exception as e:
+                    # keep the snapshot copy and try again on the next check
+                    logger.error(f'Fail to refresh symbols by REST, {e}')
+                    continue
+                self.from_snapshot = False
+
+            new_symbols = [symbol for symbol in self.symbols_info if symbol not in symbols]
+            removed_symbols = [symbol for symbol in symbols if symbol not in self.symbols_info]
+
+            symbols = set(self.symbols_info)
+            if (new_symbols or removed_symbols) and callback:
+                callback(new_symbols, removed_symbols)
+
+    def reconcile(self, callback=None):
+        '''Refresh the symbols info in background if it was loaded from cache,
+        or keep following the market snapshot, callback is called with the
+        new and removed symbols.'''
+        if self.from_snapshot:
+            thread = threading.Thread(target=self.follow_snapshot, args=(callback,), daemon=True)
+            thread.start()
+            return thread
+
+        if not self.from_cache:
+            return
+
+        def warpper():
+            try:
+                new_symbols, removed_symbols = self.update_symbols_info()
+            except Exception as e:
+                logger.error(f'Fail to reconcile symbols cache, {e}')
+                return
+
+            self.from_cache = False
+            if new_symbols or removed_symbols:
+                logger.info(f'Symbols changed since cache, new: {new_symbols}, removed: {removed_symbols}')
+                if callback:
+                    callback(new_symbols, removed_symbols)
+
+        thread = threading.Thread(target=warpper)
+        thread.start()
+        return thread
 
     def exclude(self, infos, base_price) -> 'dict[str, Symbol]':
         return {
@@ -44,6 +305,11 @@ class MarketClient(_MarketClient):
         removed_symbols = [symbol for symbol in self.symbols_info.keys() if symbol not in symbols_info]
         self.symbols_info = symbols_info
         self.mark_price = price
+        if price:
+            self.info_time = time.time()
+            self.save_cache()
+            if self.publisher:
+                self.publish_snapshot()
         return new_symbols, removed_symbols
 
     @timeout_handle({})
@@ -0,0 +1,259 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from huobi.client.trade import TradeClient
+from huobi.constant import OrderState
+from huobi.model.trade.order import Order
+
+from utils import logger
+
+HISTORY_SIZE = 1000
+HISTORY_BEFORE_MS = 60000
+FINAL_STATES = [OrderState.FILLED, OrderState.CANCELED, OrderState.PARTIAL_CANCELED]
+
+EXECUTOR_POOL_SIZE = 10
+PIPELINE_POOL_SIZE = 10
+# huobi allows 100 trade requests per 2 seconds for one account
+RATE_LIMIT = 45
+RATE_BURST = 20
+
+
+class OrderFetcher:
+    '''Fetch order details in batch, orders in a final state are cached by id.
+
+    Requests go through the executor of the account to share its rate limit.'''
+    def __init__(self, trade_client: TradeClient, executor: 'OrderExecutor'):
+        self.trade_client = trade_client
+        self.executor = executor
+        self.cache: 'dict[int, Order]' = {}
+
+    def store(self, order: Order):
+        if order and order.state in FINAL_STATES:
+            self.cache[order.id] = order
+
+    def fetch_history(self, order_ids, start_time):
+        '''Look up the finished orders since start time with one request.'''
+        try:
+            orders = self.executor.call(
+                self.trade_client.get_history_orders,
+                start_time=int(start_time * 1000) - HISTORY_BEFORE_MS,
+                size=HISTORY_SIZE
+            ) or []
+        except Exception as e:
+            logger.error(f'Fail to get history orders, {e}')
+            return
+
+        order_ids = set(order_ids)
+        for order in orders:
+            if order.id in order_ids:
+                self.store(order)
+
+    def get_order(self, order_id) -> Order:
+        try:
+            return self.trade_client.get_order(order_id)
+        except Exception as e:
+            logger.error(f'Fail to get order {order_id}, {e}')
+
+    def fetch(self, order_ids, start_time=None) -> 'list[Order]':
+        '''Orders failed to get are left out.'''
+        order_ids = [order_id for order_id in order_ids if order_id]
+        missing = [order_id for order_id in order_ids if order_id not in self.cache]
+        if len(missing) > 1 and start_time:
+            self.fetch_history(missing, start_time)
+            missing = [order_id for order_id in missing if order_id not in self.cache]
+
+        orders = {}
+        for order in self.executor.map(self.get_order, missing):
+            if order:
+                self.store(order)
+                orders[order.id] = order
+
+        return [
+            self.cache.get(order_id) or orders[order_id]
+            for order_id in order_ids
+            if order_id in self.cache or order_id in orders
+        ]
+
+
+class RateLimiter:
+    '''Token bucket, acquire blocks until a request is allowed.'''
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+class OrderExecutor:
+    '''Run the REST calls of one account concurrently under its rate limit.
+
+    Independent steps of each symbol run as pipelines, the calls inside them
+    go to a separate pool so pipelines never wait on their own pool.'''
+    def __init__(self, pool_size=EXECUTOR_POOL_SIZE, pipeline_size=PIPELINE_POOL_SIZE, limiter=None):
+        self.limiter = limiter or RateLimiter()
+        self.pool = ThreadPoolExecutor(pool_size)
+        self.pipelines = ThreadPoolExecutor(pipeline_size)
+
+    def call(self, func, *args, **kwargs):
+        self.limiter.acquire()
+        return func(*args, **kwargs)
+
+    def map(self, func, *iterables) -> list:
+        return list(self.pool.map(lambda *args: self.call(func, *args), *iterables))
+
+    def run_pipelines(self, func, *iterables) -> list:
+        def warpper(*args):
+            try:
+                return func(*args)
+            except Exception as e:
+                logger.error(f'Pipeline {func.__name__} failed, {e}')
+
+        return list(self.pipelines.map(warpper, *iterables))
+
+
+class LedgerOrder:
+    __slots__ = (
+        'order_id', 'client_order_id', 'symbol', 'side', 'order_type', 'price', 'amount',
+        'state', 'filled_amount', 'filled_cash', 'filled_fees', 'trade_ids', 'fee_ids',
+        'trade_time', 'update_time', 'detailed'
+    )
+
+    def __init__(self, order_id, symbol):
+        self.order_id = order_id
+        self.client_order_id = None
+        self.symbol = symbol
+        self.side = None
+        self.order_type = None
+        self.price = None
+        self.amount = None
+        self.state = None
+        self.filled_amount = 0
+        self.filled_cash = 0
+        self.filled_fees = 0
+        self.trade_ids = set()
+        self.fee_ids = set()
+        self.trade_time = 0
+        self.update_time = 0
+        self.detailed = False
+
+    @property
+    def avg_price(self):
+        return self.filled_cash / self.filled_amount if self.filled_amount else 0
+
+    @property
+    def is_final(self):
+        return self.state in FINAL_STATES
+
+    @property
+    def is_settled(self):
+        '''Final, and the fee of every fill is known.'''
+        return self.is_final and (self.detailed or self.trade_ids <= self.fee_ids)
+
+
+class OrderLedger:
+    '''Orders of one account indexed by id, client id, symbol, side and state.
+
+    Only orders added by us are indexed, events of unknown orders are kept by
+    id until the order is added, fills are aggregated once per trade id.'''
+    def __init__(self):
+        self.orders: 'dict[int, LedgerOrder]' = {}
+        self.client_orders: 'dict[str, LedgerOrder]' = {}
+        self.symbols: 'dict[str, list[LedgerOrder]]' = {}
+        self.sides: 'dict[str, list[LedgerOrder]]' = {}
+        self.states: 'dict[str, dict[int, LedgerOrder]]' = {}
+
+    def get_or_create(self, order_id, symbol) -> LedgerOrder:
+        if order_id not in self.orders:
+            self.orders[order_id] = LedgerOrder(order_id, symbol)
+        return self.orders[order_id]
+
+    def add(self, order_id, order, client_order_id=None) -> LedgerOrder:
+        entry = self.get_or_create(order_id, order['symbol'])
+        entry.client_order_id = client_order_id
+        entry.order_type = order['order_type']
+        entry.side = order['order_type'].split('-')[0]
+        entry.price = order.get('price')
+        entry.amount = order['amount']
+        if client_order_id:
+            self.client_orders[client_order_id] = entry
+        self.symbols.setdefault(entry.symbol, []).append(entry)
+        self.sides.setdefault(entry.side, []).append(entry)
+        self.set_state(entry, entry.state or OrderState.SUBMITTED)
+        return entry
+
+    def is_indexed(self, entry: LedgerOrder):
+        return entry.side is not None
+
+    def set_state(self, entry: LedgerOrder, state, update_time=None):
+        if entry.state in self.states:
+            self.states[entry.state].pop(entry.order_id, None)
+        entry.state = state
+        if update_time:
+            entry.update_time = update_time
+        if self.is_indexed(entry):
+            self.states.setdefault(state, {})[entry.order_id] = entry
+
+    def fill(self, order_id, symbol, trade_id, price, volume, trade_time=0, fee=None) -> LedgerOrder:
+        entry = self.get_or_create(order_id, symbol)
+        if entry.detailed:
+            # the REST totals of a final order already cover every trade
+            entry.trade_ids.add(trade_id)
+            if fee is not None:
+                entry.fee_ids.add(trade_id)
+            return entry
+
+        if trade_id not in entry.trade_ids:
+            entry.trade_ids.add(trade_id)
+            entry.filled_amount += float(volume)
+            entry.filled_cash += float(price) * float(volume)
+            entry.trade_time = max(entry.trade_time, trade_time)
+        if fee is not None and trade_id not in entry.fee_ids:
+            entry.fee_ids.add(trade_id)
+            entry.filled_fees += float(fee)
+        return entry
+
+    def update_from_order(self, order) -> LedgerOrder:
+        '''Replace the aggregated fills by the ones of a REST order detail.'''
+        entry = self.get_or_create(order.id, order.symbol)
+        entry.filled_amount = float(order.filled_amount)
+        entry.filled_cash = float(order.filled_cash_amount)
+        entry.filled_fees = float(order.filled_fees)
+        entry.trade_time = order.finished_at
+        entry.detailed = True
+        self.set_state(entry, order.state)
+        return entry
+
+    def get(self, order_id) -> LedgerOrder:
+        return self.orders.get(order_id)
+
+    def get_by_client_id(self, client_order_id) -> LedgerOrder:
+        return self.client_orders.get(client_order_id)
+
+    def by_symbol(self, symbol, side=None) -> 'list[LedgerOrder]':
+        return [entry for entry in self.symbols.get(symbol, []) if not side or entry.side == side]
+
+    def by_side(self, side) -> 'list[LedgerOrder]':
+        return self.sides.get(side, [])
+
+    def by_state(self, state) -> 'list[LedgerOrder]':
+        return list(self.states.get(state, {}).values())
+
+    def first(self, symbol, side) -> LedgerOrder:
+        orders = self.by_symbol(symbol, side)
+        return orders[0] if orders else None
+
+    def all(self) -> 'list[LedgerOrder]':
+        return [entry for entry in self.orders.values() if self.is_indexed(entry)]
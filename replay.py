@@ -0,0 +1,95 @@
+'''Replay recorded trades of one target window through the watcher logic.
+
+    python replay.py "2021-05-01 00:00:00" [symbol ...]
+'''
+import sys
+import time
+
+from huobi.model.market.trade_detail_event import TradeDetailEvent
+
+from dataset.pgsql import get_session, iter_events
+from target import Target
+from utils import logger, strftime
+from wampyapp import SELL_RATE, SECOND_SELL_RATE, State, Topic
+from watcher import MAX_WAIT, trade_detail_callback
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ReplayClient:
+    def __init__(self, target_time):
+        self.state = State.RUNNING
+        self.target_time = target_time
+        self.stop_profit = False
+        self.targets: 'dict[str, Target]' = {}
+        self.signals = []
+
+    def send_buy_signal(self, symbol, price, init_price, now, vol, start_time):
+        self.signals.append((Topic.BUY_SIGNAL, symbol, price, now))
+        target = Target(symbol, price, init_price, now)
+        target.set_buy_price(price, SECOND_SELL_RATE if self.stop_profit else SELL_RATE)
+        self.targets[symbol] = target
+
+    def send_sell_signal(self, symbol, price, init_price, now, vol, start_time):
+        self.signals.append((Topic.SELL_SIGNAL, symbol, price, now))
+        self.targets[symbol].own = False
+
+    def send_high_sell_signal(self, symbol, start_time):
+        if self.stop_profit:
+            return
+
+        self.signals.append((Topic.HIGH, symbol, self.targets[symbol].high_price, start_time))
+        for target in self.targets.values():
+            target.own = False
+        self.stop_profit = True
+
+
+def replay(target_time, symbols=None):
+    client = ReplayClient(target_time)
+    clock = SimClock()
+    callbacks = {}
+    event_num = trade_num = 0
+    cost = 0
+    start = time.perf_counter()
+
+    with get_session() as session:
+        for symbol, ms, data in iter_events(session, target_time, target_time + MAX_WAIT, symbols):
+            if symbol not in callbacks:
+                callbacks[symbol] = trade_detail_callback(symbol, client, redis=False, clock=clock)
+
+            event = TradeDetailEvent()
+            event.ch = f'market.{symbol}.trade.detail'
+            event.ts = ms
+            event.data = data
+            clock.now = ms / 1000
+
+            callback_start = time.perf_counter()
+            callbacks[symbol](event)
+            cost += time.perf_counter() - callback_start
+            event_num += 1
+            trade_num += len(data)
+
+    wall = time.perf_counter() - start
+    for topic, symbol, price, now in client.signals:
+        logger.info(f'{topic} {symbol} with price {price} at {strftime(now, fmt="%H:%M:%S")}+{round(now % 1, 3)}')
+
+    logger.info(
+        f'Replay {event_num} events, {trade_num} trades of {len(callbacks)} symbols in {round(wall, 3)}s, '
+        f'{round(MAX_WAIT / wall, 1) if wall else 0}x real time, '
+        f'{round(cost / event_num * 1e6, 2) if event_num else 0}us per event in callback'
+    )
+    return client.signals
+
+def main():
+    target_time = time.mktime(time.strptime(sys.argv[1], '%Y-%m-%d %H:%M:%S'))
+    symbols = sys.argv[2:]
+    replay(target_time, symbols)
+
+if __name__ == '__main__':
+    main()
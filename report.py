@@ -48,6 +48,11 @@ class WxPusher(_WxPusher):
         return name
 
 
+@retry(tries=5, delay=1, logger=logger)
+def _wx_push(content, uids, content_type=0, summary=None):
+    return WxPusher.send_message(content, uids=uids, content_type=content_type, summary=summary)
+
+def wx_push(content, uids, content_type=0, summary=None):
     summary = summary or content[:20]
     _wx_push(content, uids, content_type, summary)
 
@@ -73,7 +78,7 @@ def add_profit(account_id, pay, income, profit, percent, now=None):
 
     day = datetime.date.fromtimestamp(now)
     month = day.strftime('%Y-%m')
-    with get_pgsql_session() as session:
+    with get_session() as session:
         session.add(Profit(
             account=account_id,
             month=month,
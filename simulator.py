@@ -0,0 +1,446 @@
+'''Local stand-in of the Huobi REST and websocket API used by the watcher and dealer.
+
+    python simulator.py [port] [volume] ["Y-m-d H:M:S" [symbol ...]]
+
+With a time the recorded trades of that window are replayed, otherwise a
+synthetic burst is generated. Each event is pushed volume times. The burst
+starts at the next target time, point ExchangeUrl and ExchangeWsUrl of the
+config to http://127.0.0.1:port and ws://127.0.0.1:port to use it.
+'''
+import asyncio
+import gzip
+import itertools
+import json
+import random
+import string
+import sys
+import time
+
+from aiohttp import WSMsgType, web
+
+from dataset.pgsql import Trade, get_session, iter_events
+from utils import config, get_target_time, logger
+
+MAX_WAIT = config.getfloat('setting', 'MaxWait')
+SELL_AFTER = config.getfloat('setting', 'SellAfter')
+
+ACCOUNT_ID = 1
+START_USDT = 10000
+FEE_RATE = 0.002
+PING_INTERVAL = 5
+SYNTHETIC_SYMBOL_NUM = 300
+SYNTHETIC_PUMP_NUM = 3
+SYNTHETIC_TICK = 0.05
+
+
+def synthetic_symbols(num):
+    names = itertools.product(string.ascii_lowercase, repeat=3)
+    return [''.join(name) + 'usdt' for name in itertools.islice(names, num)]
+
+def ok(data, **kwargs):
+    return web.json_response({'status': 'ok', 'data': data, **kwargs})
+
+def error(msg):
+    return web.json_response({'status': 'error', 'err-code': 'invalid-parameter', 'err-msg': msg})
+
+
+class Exchange:
+    def __init__(self, symbols, volume=1):
+        self.volume = volume
+        self.prices: 'dict[str, float]' = {symbol: 1.0 for symbol in symbols}
+        self.balance: 'dict[str, list[float]]' = {'usdt': [START_USDT, 0]}
+        self.orders: 'dict[int, dict]' = {}
+        self.open_orders: 'dict[int, dict]' = {}
+        self.order_ids = itertools.count(1)
+        self.trade_ids = itertools.count(1)
+        self.market_subs: 'dict[str, set[web.WebSocketResponse]]' = {}
+        self.private_subs: 'dict[web.WebSocketResponse, set[str]]' = {}
+        self.push_num = 0
+        self.push_cost = 0
+
+    def symbol_info(self, symbol):
+        return {
+            'base-currency': symbol[:-4], 'quote-currency': 'usdt', 'symbol': symbol,
+            'price-precision': 6, 'amount-precision': 2, 'value-precision': 8,
+            'symbol-partition': 'main', 'state': 'online',
+            'min-order-amt': 0.01, 'max-order-amt': 10 ** 8, 'min-order-value': 5,
+            'limit-order-min-order-amt': 0.01, 'limit-order-max-order-amt': 10 ** 8,
+            'sell-market-min-order-amt': 0.01, 'sell-market-max-order-amt': 10 ** 8,
+            'buy-market-max-order-value': 10 ** 6, 'max-order-value': 10 ** 6
+        }
+
+    def ticker(self, symbol):
+        price = self.prices[symbol]
+        return {
+            'symbol': symbol, 'open': price, 'high': price, 'low': price, 'close': price,
+            'amount': 0, 'vol': 0, 'count': 0, 'bid': price, 'bidSize': 0, 'ask': price, 'askSize': 0
+        }
+
+    def order_data(self, order):
+        return {
+            'id': order['id'], 'symbol': order['symbol'], 'account-id': ACCOUNT_ID,
+            'amount': str(order['amount']), 'price': str(order['price']), 'type': order['type'],
+            'created-at': order['created-at'], 'finished-at': order['finished-at'],
+            'canceled-at': order['canceled-at'], 'source': 'spot-api', 'state': order['state'],
+            'client-order-id': order['client-order-id'],
+            'filled-amount': str(order['filled-amount']),
+            'filled-cash-amount': str(order['filled-cash-amount']),
+            'filled-fees': str(order['filled-fees'])
+        }
+
+    def get_balance(self, currency):
+        return self.balance.setdefault(currency, [0, 0])
+
+    def create_order(self, params):
+        symbol = params['symbol']
+        if symbol not in self.prices:
+            return {'order-id': None, 'err-code': 'invalid-symbol', 'err-msg': f'unknown {symbol}'}
+
+        side, kind = params['type'].split('-', 1)
+        amount = float(params['amount'])
+        price = float(params.get('price') or 0)
+        base = symbol[:-4]
+        now = int(time.time() * 1000)
+        order = {
+            'id': next(self.order_ids), 'symbol': symbol, 'type': params['type'],
+            'side': side, 'kind': kind, 'amount': amount, 'price': price,
+            'created-at': now, 'finished-at': 0, 'canceled-at': 0, 'state': 'submitted',
+            'client-order-id': params.get('client-order-id') or '',
+            'filled-amount': 0, 'filled-cash-amount': 0, 'filled-fees': 0
+        }
+
+        # freeze the quote for buys and the base for sells
+        currency, frozen = ('usdt', amount if kind == 'market' else amount * price) if side == 'buy' else (base, amount)
+        balance = self.get_balance(currency)
+        if balance[0] < frozen - 1e-9:
+            return {'order-id': None, 'err-code': 'insufficient-balance', 'err-msg': f'{currency} not enough'}
+
+        balance[0] -= frozen
+        balance[1] += frozen
+        order['frozen'] = frozen
+        self.orders[order['id']] = order
+        self.open_orders[order['id']] = order
+        self.push_order(order, 'creation')
+        self.push_account(currency)
+        self.match(order)
+        return {'order-id': order['id'], 'client-order-id': order['client-order-id']}
+
+    def match(self, order):
+        price = self.prices[order['symbol']]
+        if order['kind'] == 'market':
+            amount = order['amount'] / price if order['side'] == 'buy' else order['amount']
+        elif order['side'] == 'buy' and price <= order['price']:
+            amount = order['amount']
+        elif order['side'] == 'sell' and price >= order['price']:
+            amount = order['amount']
+        else:
+            return
+
+        self.fill(order, price, amount)
+
+    def fill(self, order, price, amount):
+        base = order['symbol'][:-4]
+        cash = price * amount
+        if order['side'] == 'buy':
+            fee = amount * FEE_RATE
+            usdt = self.get_balance('usdt')
+            usdt[1] -= order['frozen']
+            usdt[0] += order['frozen'] - cash
+            self.get_balance(base)[0] += amount - fee
+        else:
+            fee = cash * FEE_RATE
+            self.get_balance(base)[1] -= order['frozen']
+            self.get_balance('usdt')[0] += cash - fee
+
+        now = int(time.time() * 1000)
+        order.update({
+            'state': 'filled', 'finished-at': now, 'filled-amount': amount,
+            'filled-cash-amount': cash, 'filled-fees': fee
+        })
+        self.open_orders.pop(order['id'], None)
+        trade_id = next(self.trade_ids)
+        self.push_order(order, 'trade', trade_id, price, amount, now)
+        self.push_clearing(order, trade_id, price, amount, fee, now)
+        self.push_account('usdt')
+        self.push_account(base)
+
+    def cancel_order(self, order_id):
+        order = self.open_orders.pop(order_id, None)
+        if not order:
+            return False
+
+        currency = 'usdt' if order['side'] == 'buy' else order['symbol'][:-4]
+        balance = self.get_balance(currency)
+        balance[0] += order['frozen']
+        balance[1] -= order['frozen']
+        order['state'] = 'canceled'
+        order['canceled-at'] = order['finished-at'] = int(time.time() * 1000)
+        self.push_order(order, 'cancellation')
+        self.push_account(currency)
+        return True
+
+    def push_private(self, ch, data):
+        message = json.dumps({'action': 'push', 'ch': ch, 'data': data})
+        for ws, channels in list(self.private_subs.items()):
+            if ch in channels or ch.split('#')[0] + '#*' in channels:
+                asyncio.ensure_future(ws.send_str(message))
+
+    def push_order(self, order, event_type, trade_id=None, price=None, amount=None, trade_time=None):
+        data = {
+            'eventType': event_type, 'symbol': order['symbol'], 'accountId': ACCOUNT_ID,
+            'orderId': order['id'], 'clientOrderId': order['client-order-id'],
+            'orderStatus': order['state'], 'type': order['type'],
+            'orderPrice': str(order['price']), 'orderSize': str(order['amount'])
+        }
+        if event_type == 'trade':
+            data.update({
+                'tradeId': trade_id, 'tradePrice': str(price), 'tradeVolume': str(amount),
+                'tradeTime': trade_time, 'aggressor': True, 'remainAmt': '0'
+            })
+        self.push_private(f'orders#{order["symbol"]}', data)
+
+    def push_clearing(self, order, trade_id, price, amount, fee, trade_time):
+        self.push_private(f'trade.clearing#{order["symbol"]}', {
+            'symbol': order['symbol'], 'orderId': order['id'], 'tradeId': trade_id,
+            'tradePrice': str(price), 'tradeVolume': str(amount), 'orderSide': order['side'],
+            'orderType': order['type'], 'aggressor': True, 'tradeTime': trade_time,
+            'transactFee': str(fee), 'feeDeduct': '0', 'feeDeductType': ''
+        })
+
+    def push_account(self, currency):
+        trade, frozen = self.get_balance(currency)
+        self.push_private('accounts.update#1', {
+            'currency': currency, 'accountId': ACCOUNT_ID, 'accountType': 'trade',
+            'balance': str(trade + frozen), 'available': str(trade),
+            'changeType': 'order.match', 'changeTime': int(time.time() * 1000)
+        })
+
+    async def push_trades(self, symbol, ts, trades):
+        '''Push one trade detail event of (price, amount, direction), newest first.'''
+        self.prices[symbol] = trades[0][0]
+        for order in [order for order in self.open_orders.values() if order['symbol'] == symbol]:
+            self.match(order)
+
+        subs = self.market_subs.get(symbol)
+        if not subs:
+            return
+
+        start = time.perf_counter()
+        ch = f'market.{symbol}.trade.detail'
+        for _ in range(self.volume):
+            trade_id = next(self.trade_ids)
+            message = gzip.compress(json.dumps({'ch': ch, 'ts': ts, 'tick': {'id': trade_id, 'ts': ts, 'data': [{
+                'id': trade_id * 100 + i, 'tradeId': trade_id * 100 + i, 'ts': ts,
+                'price': price, 'amount': amount, 'direction': direction
+            } for i, (price, amount, direction) in enumerate(trades)]}}).encode())
+            for ws in list(subs):
+                await ws.send_bytes(message)
+        self.push_num += self.volume
+        self.push_cost += time.perf_counter() - start
+
+
+class Simulator:
+    def __init__(self, exchange: Exchange):
+        self.exchange = exchange
+        self.app = web.Application()
+        self.app.add_routes([
+            web.get('/v1/common/timestamp', self.timestamp),
+            web.get('/v1/common/symbols', self.symbols),
+            web.get('/market/tickers', self.tickers),
+            web.get('/v1/account/accounts', self.accounts),
+            web.get('/v1/account/accounts/{account_id}/balance', self.balance),
+            web.post('/v1/order/batch-orders', self.batch_orders),
+            web.get('/v1/order/openOrders', self.open_orders),
+            web.post('/v1/order/orders/batchcancel', self.batch_cancel),
+            web.get('/v1/order/orders/{order_id}', self.order),
+            web.get('/v1/order/history', self.history),
+            web.get('/ws', self.market_ws),
+            web.get('/ws/v2', self.private_ws)
+        ])
+
+    async def timestamp(self, request):
+        return ok(int(time.time() * 1000))
+
+    async def symbols(self, request):
+        return ok([self.exchange.symbol_info(symbol) for symbol in self.exchange.prices])
+
+    async def tickers(self, request):
+        return ok([self.exchange.ticker(symbol) for symbol in self.exchange.prices], ts=int(time.time() * 1000))
+
+    async def accounts(self, request):
+        return ok([{'id': ACCOUNT_ID, 'type': 'spot', 'subtype': '', 'state': 'working'}])
+
+    async def balance(self, request):
+        balance_list = []
+        for currency, (trade, frozen) in self.exchange.balance.items():
+            balance_list.append({'currency': currency, 'type': 'trade', 'balance': str(trade)})
+            balance_list.append({'currency': currency, 'type': 'frozen', 'balance': str(frozen)})
+        return ok({'id': ACCOUNT_ID, 'type': 'spot', 'state': 'working', 'list': balance_list})
+
+    async def batch_orders(self, request):
+        params = await request.json()
+        return ok([self.exchange.create_order(each) for each in params])
+
+    async def open_orders(self, request):
+        symbols = request.query.get('symbol', '').split(',')
+        side = request.query.get('side')
+        return ok([
+            self.exchange.order_data(order) for order in self.exchange.open_orders.values()
+            if order['symbol'] in symbols and (not side or order['side'] == side)
+        ])
+
+    async def batch_cancel(self, request):
+        params = await request.json()
+        order_ids = [int(order_id) for order_id in params.get('order-ids', [])]
+        success = [str(order_id) for order_id in order_ids if self.exchange.cancel_order(order_id)]
+        failed = [
+            {'order-id': str(order_id), 'err-code': 'order-orderstate-error', 'err-msg': 'not open'}
+            for order_id in order_ids if str(order_id) not in success
+        ]
+        return ok({'success': success, 'failed': failed})
+
+    async def order(self, request):
+        order = self.exchange.orders.get(int(request.match_info['order_id']))
+        if not order:
+            return error('order not found')
+        return ok(self.exchange.order_data(order))
+
+    async def history(self, request):
+        start_time = int(request.query.get('start-time', 0))
+        return ok([
+            self.exchange.order_data(order) for order in self.exchange.orders.values()
+            if order['id'] not in self.exchange.open_orders and order['created-at'] >= start_time
+        ])
+
+    async def ping(self, ws, message):
+        while not ws.closed:
+            await asyncio.sleep(PING_INTERVAL)
+            try:
+                await message()
+            except ConnectionError:
+                break
+
+    async def market_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        ping = asyncio.ensure_future(self.ping(ws, lambda: ws.send_bytes(
+            gzip.compress(json.dumps({'ping': int(time.time() * 1000)}).encode())
+        )))
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+
+            data = json.loads(msg.data)
+            if 'sub' in data:
+                symbol = data['sub'].split('.')[1]
+                self.exchange.market_subs.setdefault(symbol, set()).add(ws)
+                await ws.send_bytes(gzip.compress(json.dumps({
+                    'id': data.get('id'), 'status': 'ok', 'subbed': data['sub'], 'ts': int(time.time() * 1000)
+                }).encode()))
+
+        ping.cancel()
+        for subs in self.exchange.market_subs.values():
+            subs.discard(ws)
+        return ws
+
+    async def private_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.exchange.private_subs[ws] = set()
+        ping = asyncio.ensure_future(self.ping(ws, lambda: ws.send_str(json.dumps({
+            'action': 'ping', 'data': {'ts': int(time.time() * 1000)}
+        }))))
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+
+            data = json.loads(msg.data)
+            if data.get('action') == 'req' and data.get('ch') == 'auth':
+                await ws.send_str(json.dumps({'action': 'req', 'code': 200, 'ch': 'auth', 'data': {}}))
+            elif data.get('action') == 'sub':
+                # orders#a,b,c subscribes every symbol
+                topic, symbols = data['ch'].split('#')
+                for symbol in symbols.split(','):
+                    self.exchange.private_subs[ws].add(f'{topic}#{symbol}')
+                await ws.send_str(json.dumps({'action': 'sub', 'code': 200, 'ch': data['ch'], 'data': {}}))
+
+        ping.cancel()
+        self.exchange.private_subs.pop(ws, None)
+        return ws
+
+
+def synthetic_events(symbols, duration, pump_num=SYNTHETIC_PUMP_NUM, tick=SYNTHETIC_TICK):
+    '''Yield (offset, symbol, trades), a few symbols pump 6% in the first seconds.'''
+    prices = {symbol: 1.0 for symbol in symbols}
+    pumps = set(random.sample(symbols, min(pump_num, len(symbols))))
+    for step in range(int(duration / tick)):
+        offset = step * tick
+        for symbol in symbols:
+            if symbol in pumps and offset < 2:
+                prices[symbol] *= 1 + 0.06 * tick / 2
+                amount = 3000
+            else:
+                prices[symbol] *= 1 + random.uniform(-0.002, 0.002)
+                amount = random.uniform(1, 100)
+            trades = [
+                (round(prices[symbol], 6), round(amount * random.random(), 2), random.choice(['buy', 'sell']))
+                for _ in range(random.randint(1, 3))
+            ]
+            yield offset, symbol, trades
+
+def recorded_events(window_time, symbols=None):
+    with get_session() as session:
+        for symbol, ms, data in iter_events(session, window_time, window_time + MAX_WAIT + SELL_AFTER, symbols):
+            yield ms / 1000 - window_time, symbol, [(each.price, each.amount, each.direction) for each in data]
+
+def recorded_symbols(window_time):
+    with get_session() as session:
+        return [symbol for symbol, in session.query(Trade.symbol).filter(
+            Trade.ts >= int(window_time * 1e6),
+            Trade.ts <= int((window_time + MAX_WAIT) * 1e6)
+        ).distinct()]
+
+async def run_burst(exchange: Exchange, events):
+    target_time = get_target_time()
+    await asyncio.sleep(max(target_time - time.time(), 0))
+    logger.info('Burst start')
+
+    # offsets of the events are kept, each push goes out at target time + offset
+    lag = []
+    for offset, symbol, trades in events:
+        delay = target_time + offset - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            lag.append(-delay)
+        await exchange.push_trades(symbol, int((target_time + offset) * 1000), trades)
+
+    lag.sort()
+    logger.info(
+        f'Burst end, {exchange.push_num} pushes, {round(exchange.push_cost / max(exchange.push_num, 1) * 1e6, 2)}us per push, '
+        f'{len(lag)} late, p99 lag {round(lag[int(len(lag) * 0.99)] * 1000, 3) if lag else 0}ms'
+    )
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8888
+    volume = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    if len(sys.argv) > 3:
+        window_time = time.mktime(time.strptime(sys.argv[3], '%Y-%m-%d %H:%M:%S'))
+        symbols = sys.argv[4:] or recorded_symbols(window_time)
+        events = recorded_events(window_time, sys.argv[4:])
+    else:
+        symbols = synthetic_symbols(SYNTHETIC_SYMBOL_NUM)
+        events = synthetic_events(symbols, MAX_WAIT + SELL_AFTER)
+
+    exchange = Exchange(symbols, volume)
+    simulator = Simulator(exchange)
+    loop = asyncio.get_event_loop()
+    runner = web.AppRunner(simulator.app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '0.0.0.0', port).start())
+    logger.info(f'Simulator of {len(symbols)} symbols on port {port}, volume x{volume}')
+    loop.run_until_complete(run_burst(exchange, events))
+    loop.run_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import threading
+
+import numpy as np
+
+from utils import config
+
+BOOT_RATE = config.getfloat('setting', 'BootRate')
+END_RATE = config.getfloat('setting', 'EndRate')
+MIN_VOL = config.getfloat('setting', 'MinVol')
+MAX_BUY_BACK_RATE = config.getfloat('setting', 'MaxBuyBackRate')
+
+BOOT_MUL = 1 + BOOT_RATE / 100
+END_MUL = 1 + END_RATE / 100
+
+
+class SymbolState:
+    __slots__ = (
+        'symbol', 'interval_ms', 'last', 'price', 'open_',
+        'high', 'vol', 'max_back', 'boot_price', 'end_price'
+    )
+
+    def __init__(self, symbol, interval=300):
+        self.symbol = symbol
+        self.interval_ms = interval * 1000
+        self.last = 0
+        self.price = 0
+        self.open_ = 0
+        self.high = 0
+        self.vol = 0
+        self.max_back = 0
+        self.boot_price = 0
+        self.end_price = 0
+
+    def update(self, trades) -> bool:
+        '''Apply one websocket event, newest trade first, and return whether
+        the buy signal pre-checks (volume, drawback and price band) pass.'''
+        detail = trades[0]
+        price = detail.price
+        vol = 0
+        for each in trades:
+            vol += each.price * each.amount
+
+        last = detail.ts // self.interval_ms
+        if last > self.last:
+            open_ = trades[-1].price
+            self.last = last
+            self.open_ = open_
+            self.vol = vol
+            self.boot_price = open_ * BOOT_MUL
+            self.end_price = open_ * END_MUL
+            self.high = open_ if open_ > price else price
+        else:
+            self.vol += vol
+            high = self.high
+            if price > high:
+                self.high = high = price
+            back = 1 - price / high
+            if back > self.max_back:
+                self.max_back = back
+
+        self.price = price
+        return (
+            self.vol >= MIN_VOL
+            and self.max_back <= MAX_BUY_BACK_RATE
+            and self.boot_price < price < self.end_price
+        )
+
+
+class VectorState:
+    '''State of many symbols in arrays, updated by micro-batches of events.'''
+    def __init__(self, symbols, interval=300):
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.interval_ms = interval * 1000
+        self.lock = threading.Lock()
+        self.pending = []
+
+        num = len(self.symbols)
+        self.last = np.zeros(num, np.int64)
+        self.now = np.zeros(num, np.int64)
+        self.price = np.zeros(num)
+        self.open_ = np.zeros(num)
+        self.high = np.zeros(num)
+        self.vol = np.zeros(num)
+        self.max_back = np.zeros(num)
+        self.boot_price = np.zeros(num)
+        self.end_price = np.zeros(num)
+        self.own = np.zeros(num, bool)
+        self.has_target = np.zeros(num, bool)
+        self.target_high = np.zeros(num)
+        self.sell_least_price = np.zeros(num)
+        self.sell_least_time = np.zeros(num)
+
+    def push(self, index, trades):
+        vol = 0
+        for each in trades:
+            vol += each.price * each.amount
+
+        with self.lock:
+            self.pending.append((index, trades[0].ts, trades[0].price, trades[-1].price, vol))
+
+    def set_targets(self, targets):
+        self.has_target[:] = False
+        self.own[:] = False
+        for symbol, target in targets.items():
+            if symbol not in self.index:
+                continue
+
+            index = self.index[symbol]
+            self.has_target[index] = True
+            self.own[index] = target.own and target.high_price > 0
+            self.target_high[index] = target.high_price
+            self.sell_least_price[index] = target.sell_least_price
+            self.sell_least_time[index] = target.sell_least_time * 1000
+
+    def apply(self) -> np.ndarray:
+        '''Apply pending events, return indexes of the updated symbols.'''
+        with self.lock:
+            batch, self.pending = self.pending, []
+
+        if not batch:
+            return np.zeros(0, np.int64)
+
+        batch = np.array(batch)
+        batch = batch[np.argsort(batch[:, 0], kind='stable')]
+        index, ts = batch[:, 0].astype(np.int64), batch[:, 1].astype(np.int64)
+        price, first, vol = batch[:, 2], batch[:, 3], batch[:, 4]
+        last = ts // self.interval_ms
+
+        # events are grouped by symbol and window, every group but a symbol's
+        # first one starts a new window, as does a first one newer than the state
+        num = len(index)
+        new_symbol = np.r_[True, index[1:] != index[:-1]]
+        new_group = new_symbol | np.r_[False, last[1:] != last[:-1]]
+        group = np.cumsum(new_group) - 1
+        group_starts = np.flatnonzero(new_group)
+        roll = ~new_symbol[group_starts] | (last[group_starts] > self.last[index[group_starts]])
+        seed = np.where(roll, first[group_starts], self.high[index[group_starts]])
+        is_roll = np.zeros(num, bool)
+        is_roll[group_starts[roll]] = True
+
+        # running high inside each group, scaled by the seed so groups can be offset
+        ratio = price / seed[group]
+        offset = (max(ratio.max(), 1) + 1) * group
+        high = np.maximum(np.maximum.accumulate(ratio + offset) - offset, 1) * seed[group]
+        back = np.where(is_roll, 0, 1 - price / high)
+        np.maximum.at(self.max_back, index, back)
+
+        symbol_ends = np.r_[np.flatnonzero(new_symbol)[1:], num] - 1
+        symbols = index[symbol_ends]
+        last_group = group[symbol_ends]
+        last_start = group_starts[last_group]
+        rolled = roll[last_group]
+
+        roll_symbols = symbols[rolled]
+        open_ = first[last_start[rolled]]
+        self.last[roll_symbols] = last[last_start[rolled]]
+        self.open_[roll_symbols] = open_
+        self.vol[roll_symbols] = 0
+        self.boot_price[roll_symbols] = open_ * BOOT_MUL
+        self.end_price[roll_symbols] = open_ * END_MUL
+
+        in_last = group == last_group[np.cumsum(new_symbol) - 1]
+        np.add.at(self.vol, index[in_last], vol[in_last])
+        self.high[symbols] = high[symbol_ends]
+        self.price[symbols] = price[symbol_ends]
+        self.now[symbols] = ts[symbol_ends]
+        return symbols
+
+    def check(self, symbols):
+        '''Return indexes of the symbols with buy, high sell and sell signal.'''
+        price = self.price[symbols]
+        buy = (
+            ~self.has_target[symbols]
+            & (self.vol[symbols] >= MIN_VOL)
+            & (self.max_back[symbols] <= MAX_BUY_BACK_RATE)
+            & (self.boot_price[symbols] < price)
+            & (price < self.end_price[symbols])
+        )
+        own = self.own[symbols]
+        high_sell = own & (price > self.target_high[symbols])
+        sell = own & (price < self.sell_least_price[symbols]) & (self.now[symbols] > self.sell_least_time[symbols])
+        return symbols[buy], symbols[high_sell], symbols[sell]
@@ -13,6 +13,7 @@ class Target:
         self.high_price = 0
 
         self.time = time
+        self.receive_time = None
 
         self.sell_least_time = time + SELL_LEAST_AFTER
         self.sell_least_price = init_price * (1 - SELL_BACK_RATE / 100)
@@ -33,11 +34,11 @@ class Target:
         self.min_order_value = info.min_order_value
         self.sell_market_min_order_amt = info.sell_market_min_order_amt
         self.limit_order_min_order_amt = info.limit_order_min_order_amt
+        self.amount_precision_num = 10 ** info.amount_precision
+        self.price_precision_num = 10 ** info.price_precision
 
     def check_amount(self, amount):
-        precision_num = 10 ** self.amount_precision
-        return math.floor(amount * precision_num) / precision_num
+        return math.floor(amount * self.amount_precision_num) / self.amount_precision_num
 
     def check_price(self, price):
-        precision_num = 10 ** self.price_precision
-        return math.floor(price * precision_num) / precision_num
\ No newline at end of file
+        return math.floor(price * self.price_precision_num) / self.price_precision_num
\ No newline at end of file
@@ -1,24 +1,36 @@
 import math
+import threading
 import time
 
 import huobi
 from huobi.client.account import AccountClient
 from huobi.client.trade import TradeClient
-from huobi.constant import OrderSource, OrderSide, OrderType
+from huobi.constant import AccountBalanceMode, OrderSource, OrderSide, OrderState, OrderType
+from huobi.model.account.account_update_event import AccountUpdateEvent
+from huobi.model.trade.order_update_event import OrderUpdateEvent
+from huobi.model.trade.trade_clearing_event import TradeClearingEvent
+from huobi.service.trade.post_batch_create_order import PostBatchCreateOrderService
 
+from order import FINAL_STATES, OrderExecutor, OrderFetcher, OrderLedger
 from utils import config, logger, strftime, timeout_handle
+from utils.connection import ADAPTER
+from utils.metrics import LATENCY
 from report import wx_report, add_profit, get_profit, wx_name
 
 SELL_RATE = config.getfloat('setting', 'SellRate')
 SECOND_SELL_RATE = config.getfloat('setting', 'SecondSellRate')
 MAX_BUY_RATE = config.getfloat('setting', 'MaxBuyRate')
 
+STREAM_TIMEOUT = 5
+STREAM_BALANCE_WAIT = 0.3
+
 class User:
     def __init__(self, access_key, secret_key, buy_amount, wxuid):
         self.access_key = access_key
         self.sercet_key = secret_key
         self.account_client = AccountClient(api_key=access_key, secret_key=secret_key)
         self.trade_client = TradeClient(api_key=access_key, secret_key=secret_key)
+        self.trade_kwargs = {'api_key': access_key, 'secret_key': secret_key}
         self.account_id = next(filter(
             lambda account: account.type=='spot' and account.state =='working',
             self.account_client.get_accounts()
@@ -34,13 +46,160 @@ class User:
         self.wxuid = wxuid.split(';')
 
         self.balance = {}
-        self.buy_order_list = []
-        self.sell_order_list = []
-        self.buy_id = []
-        self.sell_id = []
+        self.ledger = OrderLedger()
         self.username = wx_name(self.wxuid[0])
         self.high = True
 
+        # None until start_stream, False after a stream error
+        self.streaming = None
+        self.stream_condition = threading.Condition()
+        self.stream_balance: 'dict[str, dict]' = {}
+        self.order_templates: 'dict[tuple[str, str], dict]' = {}
+        self.executor = OrderExecutor()
+        self.order_fetcher = OrderFetcher(self.trade_client, self.executor)
+        self.first_order_time = None
+
+    def arm(self, symbols):
+        '''Build the request params of every order type for the symbols ahead of time.'''
+        for symbol in symbols:
+            for order_type in [OrderType.BUY_LIMIT, OrderType.BUY_MARKET, OrderType.SELL_LIMIT, OrderType.SELL_MARKET]:
+                self.order_templates[symbol, order_type] = {
+                    "account-id": self.account_id,
+                    "amount": None,
+                    "price": None,
+                    "symbol": symbol,
+                    "type": order_type,
+                    "source": OrderSource.SPOT_API,
+                    "client-order-id": None,
+                    "stop-price": None,
+                    "operator": None
+                }
+        logger.info(f'User {self.account_id} armed {len(self.order_templates)} order templates')
+
+    def create_orders(self, order_list):
+        if not self.first_order_time:
+            self.first_order_time = time.time()
+
+        params = []
+        for order in order_list:
+            template = self.order_templates.get((order['symbol'], order['order_type']))
+            if not template:
+                params = None
+                break
+
+            param = template.copy()
+            param['amount'] = order['amount']
+            if order['order_type'] in [OrderType.BUY_LIMIT, OrderType.SELL_LIMIT]:
+                param['price'] = order['price']
+            params.append(param)
+
+        if params:
+            order_ids = self.executor.call(PostBatchCreateOrderService(params).request, **self.trade_kwargs)
+        else:
+            order_ids = self.executor.call(self.trade_client.batch_create_order, order_list)
+
+        with self.stream_condition:
+            for order_id, order in zip(order_ids, order_list):
+                if order_id.order_id:
+                    self.ledger.add(order_id.order_id, order, order_id.client_order_id)
+                else:
+                    logger.error(f'Fail to create {order["order_type"]} order of {order["symbol"]}, {order_id.err_msg}')
+        return order_ids
+
+    def sub_order_stream(self, symbols):
+        if symbols:
+            self.trade_client.sub_order_update(','.join(symbols), self.order_update_callback, self.stream_error_callback)
+
+    def start_stream(self, symbols):
+        self.sub_order_stream(symbols)
+        self.account_client.sub_account_update(AccountBalanceMode.TOTAL, self.account_update_callback, self.stream_error_callback)
+        self.trade_client.sub_trade_clearing('*', self.trade_clearing_callback, self.stream_error_callback)
+        snapshot: 'dict[str, dict]' = {}
+        for currency in self.account_client.get_balance(self.account_id):
+            balance = snapshot.setdefault(currency.currency, {'total': 0, 'trade': 0, 'time': 0})
+            balance['total'] += float(currency.balance)
+            if currency.type == 'trade':
+                balance['trade'] = float(currency.balance)
+
+        with self.stream_condition:
+            for currency, balance in snapshot.items():
+                # an update since the subscribe is newer than the snapshot
+                if not self.stream_balance.get(currency, {}).get('time'):
+                    self.stream_balance[currency] = balance
+        self.streaming = True
+
+    def stream_alive(self):
+        '''Any update means the sdk reconnected after an error.'''
+        if self.streaming is False:
+            self.streaming = True
+            logger.info(f'User {self.account_id} stream recovered')
+
+    def order_update_callback(self, event: OrderUpdateEvent):
+        data = event.data
+        with self.stream_condition:
+            self.stream_alive()
+            if data.eventType == 'trade':
+                entry = self.ledger.fill(data.orderId, data.symbol, data.tradeId, data.tradePrice, data.tradeVolume, data.tradeTime)
+            else:
+                entry = self.ledger.get_or_create(data.orderId, data.symbol)
+            self.ledger.set_state(entry, data.orderStatus, time.time())
+            self.stream_condition.notify_all()
+
+    def trade_clearing_callback(self, event: TradeClearingEvent):
+        data = event.data
+        with self.stream_condition:
+            self.stream_alive()
+            self.ledger.fill(
+                data.orderId, data.symbol, data.tradeId, data.tradePrice,
+                data.tradeVolume, data.tradeTime, data.transactFee or 0
+            )
+            self.stream_condition.notify_all()
+
+    def account_update_callback(self, event: AccountUpdateEvent):
+        data = event.data
+        if not data.currency:
+            return
+
+        with self.stream_condition:
+            self.stream_alive()
+            balance = self.stream_balance.setdefault(data.currency, {'total': 0, 'trade': 0, 'time': 0})
+            if data.balance:
+                balance['total'] = float(data.balance)
+            if data.available:
+                balance['trade'] = float(data.available)
+            balance['time'] = time.time()
+            self.stream_condition.notify_all()
+
+    def stream_error_callback(self, error):
+        self.streaming = False
+        logger.error(f'User {self.account_id} stream error, {error}')
+
+    def get_stream_frozen(self, currency):
+        balance = self.stream_balance.get(currency, {'total': 0, 'trade': 0})
+        return round(balance['total'] - balance['trade'], 10)
+
+    def wait_stream_orders(self, targets, timeout=STREAM_TIMEOUT) -> bool:
+        with self.stream_condition:
+            orders = [order for target in targets for order in self.ledger.by_symbol(target.symbol)]
+            is_done = lambda: all([order.is_final for order in orders])
+            if not self.streaming or not self.stream_condition.wait_for(is_done, timeout):
+                return False
+
+            # account update of the last fill or cancel may come just after the order update
+            last = max([order.update_time for order in orders], default=0)
+            currencies = set([target.base_currency for target in targets])
+            self.stream_condition.wait_for(lambda: all(
+                self.stream_balance.get(currency, {}).get('time', 0) >= last
+                for currency in currencies
+            ), STREAM_BALANCE_WAIT)
+            return True
+
+    def wait_stream_frozen(self, currencies, timeout=STREAM_TIMEOUT) -> bool:
+        with self.stream_condition:
+            return self.streaming and self.stream_condition.wait_for(lambda: not any([
+                self.get_stream_frozen(currency) > 0 for currency in currencies
+            ]), timeout)
+
     def buy(self, targets, amounts):
         buy_order_list = [{
             "symbol": target.symbol,
@@ -56,8 +215,10 @@ class User:
             if amount > 0
         ]
         if buy_order_list:
-            self.buy_id.extend(self.trade_client.batch_create_order(buy_order_list))
-            self.buy_order_list.extend(buy_order_list)
+            is_first = not self.ledger.by_side(OrderSide.BUY)
+            self.create_orders(buy_order_list)
+            if is_first and not ADAPTER.last_reused:
+                logger.warning(f'User {self.account_id} first order opened a new connection')
             # logger.debug(f'User {self.account_id} buy report')
             for order in buy_order_list:
                 logger.debug(f'Speed {order["amount"]} USDT to buy {order["symbol"][:-4].upper()}')
@@ -101,8 +262,15 @@ class User:
             ]
 
         if buy_order_list:
-            self.buy_id.extend(self.trade_client.batch_create_order(buy_order_list))
-            self.buy_order_list.extend(buy_order_list)
+            for target in targets:
+                if target.receive_time:
+                    LATENCY.record('prepare', target.receive_time)
+            is_first = not self.ledger.by_side(OrderSide.BUY)
+            self.create_orders(buy_order_list)
+            if is_first and not ADAPTER.last_reused:
+                logger.warning(f'User {self.account_id} first order opened a new connection')
+            for target in targets:
+                LATENCY.record('order', target.time)
             # logger.debug(f'User {self.account_id} buy report')
             for order in buy_order_list:
                 logger.debug(f'Speed {order["amount"]} USDT to buy {order["symbol"][:-4].upper()}')
@@ -123,8 +291,7 @@ class User:
         ]
         
         if sell_order_list:
-            self.sell_id.extend(self.trade_client.batch_create_order(sell_order_list))
-            self.sell_order_list.extend(sell_order_list)
+            self.create_orders(sell_order_list)
             # logger.debug(f'User {self.account_id} sell report')
             for order in sell_order_list:
                 logger.debug(f'Sell {order["amount"]} {order["symbol"][:-4].upper()} with market price')
@@ -159,8 +326,7 @@ class User:
         ]
 
         if sell_order_list:
-            self.sell_id.extend(self.trade_client.batch_create_order(sell_order_list))
-            self.sell_order_list.extend(sell_order_list)
+            self.create_orders(sell_order_list)
             # logger.debug(f'User {self.account_id} sell report')
             for order in sell_order_list:
                 logger.debug(f'Sell {order["amount"]} {order["symbol"][:-4].upper()} with price {order["price"]}')
@@ -168,54 +334,54 @@ class User:
  
     @timeout_handle([])
     def get_open_orders(self, targets, side=OrderSide.SELL) -> 'list[huobi.model.trade.order.Order]':
-        open_orders = []
         all_symbols = [target.symbol for target in targets]
-        for symbols in [all_symbols[i:i+10] for i in range(0, len(all_symbols), 10)]:
-            open_orders.extend(self.trade_client.get_open_orders(','.join(symbols), self.account_id, side))
+        chunks = [all_symbols[i:i+10] for i in range(0, len(all_symbols), 10)]
+        open_orders = []
+        for orders in self.executor.map(
+            lambda symbols: self.trade_client.get_open_orders(','.join(symbols), self.account_id, side),
+            chunks
+        ):
+            open_orders.extend(orders)
         return open_orders
 
-    def cancel_and_sell(self, targets):
-        open_orders = self.get_open_orders(targets)
+    def cancel_target(self, target):
+        open_orders = self.executor.call(self.trade_client.get_open_orders, target.symbol, self.account_id, OrderSide.SELL)
         if open_orders:
-            all_symbols = [target.symbol for target in targets]
-            for symbols in [all_symbols[i:i+10] for i in range(0, len(all_symbols), 10)]:
-                self.trade_client.cancel_orders(','.join(symbols), [order.id for order in open_orders if order.symbol in symbols])
-            logger.info(f'Cancel open sell orders for {", ".join(all_symbols)}')
+            self.executor.call(self.trade_client.cancel_orders, target.symbol, [order.id for order in open_orders])
+            logger.info(f'Cancel open sell orders for {target.symbol}')
 
-        self.get_balance(targets)
-        amounts = [self.balance[target.base_currency] for target in targets]
-        self.sell(targets, amounts)
+    def cancel_and_sell_target(self, target):
+        self.cancel_target(target)
+        balance = self.get_balance([target])
+        self.sell([target], [balance[target.base_currency]])
 
-        target_currencies = [target.base_currency for target in targets]
-        while True:
-            frozen_balance = self.get_currency_balance(target_currencies, 'frozen')
+        while not self.wait_stream_frozen([target.base_currency]):
+            frozen_balance = self.get_currency_balance([target.base_currency], 'frozen')
             if not any(frozen_balance.values()):
                 break
             else:
                 time.sleep(0.1)
-        
+
+    def cancel_and_sell(self, targets):
+        self.executor.run_pipelines(self.cancel_and_sell_target, targets)
         self.get_balance(targets)
-        amounts = [self.balance[target.base_currency] for target in targets]
 
+    def high_cancel_and_sell_target(self, target, symbol, price):
+        self.cancel_target(target)
+        balance = self.get_balance([target])
+        if target.symbol == symbol:
+            prices = [(price + target.buy_price * (1 + SELL_RATE / 100)) / 2]
+            self.sell_limit([target], [balance[target.base_currency]], prices=prices)
+        else:
+            self.sell_limit([target], [balance[target.base_currency]])
 
     def high_cancel_and_sell(self, targets, symbol, price):
         self.high = False
-        open_orders = self.get_open_orders(targets)
-        if open_orders:
-            all_symbols = [target.symbol for target in targets]
-            for symbols in [all_symbols[i:i+10] for i in range(0, len(all_symbols), 10)]:
-                self.trade_client.cancel_orders(','.join(symbols), [order.id for order in open_orders if order.symbol in symbols])
-            logger.info(f'Cancel open sell orders for {", ".join(all_symbols)}')
-
-        self.get_balance(targets)
-        symbol_targets = [target for target in targets if target.symbol == symbol]
-        symbol_amounts = [self.balance[target.base_currency] for target in symbol_targets]
-        other_targets = [target for target in targets if target.symbol != symbol]
-        other_amounts = [self.balance[target.base_currency] for target in other_targets]
-
-        prices = [(price + target.buy_price * (1 + SELL_RATE / 100)) / 2 for target in symbol_targets]
-        self.sell_limit(symbol_targets, symbol_amounts, prices=prices)
-        self.sell_limit(other_targets, other_amounts)
+        targets = list(targets)
+        self.executor.run_pipelines(
+            self.high_cancel_and_sell_target,
+            targets, [symbol] * len(targets), [price] * len(targets)
+        )
 
         # target_currencies = [target.base_currency for target in targets]
         # while True:
@@ -237,55 +403,75 @@ class User:
     def get_currency_balance(self, currencies, balance_type='trade'):
         return {
             currency.currency: float(currency.balance)
-            for currency in self.account_client.get_balance(self.account_id)
+            for currency in self.executor.call(self.account_client.get_balance, self.account_id)
             if currency.currency in currencies and currency.type == balance_type
         }
 
-    def get_balance(self, targets):
-        while self.get_open_orders(targets, side=None):
-            pass
-
+    def get_balance(self, targets) -> 'dict[str, float]':
         target_currencies = [target.base_currency for target in targets]
-        self.balance = self.get_currency_balance(target_currencies)
+        if self.wait_stream_orders(targets):
+            with self.stream_condition:
+                balance = {
+                    currency: self.stream_balance.get(currency, {'trade': 0})['trade']
+                    for currency in target_currencies
+                }
+        else:
+            while self.get_open_orders(targets, side=None):
+                pass
+
+            balance = self.get_currency_balance(target_currencies)
+
+        self.balance.update(balance)
+        return balance
 
     def check_balance(self, targets):
         self.get_balance(targets)
 
+        orders = {target.symbol: self.ledger.first(target.symbol, OrderSide.BUY) for target in targets}
+        self.fetch_orders([
+            orders[target.symbol] for target in targets
+            if self.balance[target.base_currency] > 10 ** -target.amount_precision
+            and orders[target.symbol]
+        ], lambda order: order.is_final and order.filled_amount)
+
         # logger.debug(f'User {self.account_id} balance report')
         for target in targets:
-            for order_id, order in zip(self.buy_id, self.buy_order_list):
-                if order['symbol'] == target.symbol:
-                    break
-
-            
             target_balance = self.balance[target.base_currency]
-            if target_balance > 10 ** -target.amount_precision:
-                order_detail = self.trade_client.get_order(order_id.order_id)
-                buy_price = float(order_detail.filled_cash_amount) / float(order_detail.filled_amount)
+            if target_balance > 10 ** -target.amount_precision and orders[target.symbol]:
+                buy_price = orders[target.symbol].avg_price
                 target.buy_price = buy_price
                 logger.debug(f'Get {target_balance} {target.base_currency.upper()} with average price {buy_price}')
             else:
                 target.buy_price = 0
                 logger.debug(f'Get no {target.base_currency.upper()}')
 
+            LATENCY.record('balance', target.time)
+
+    def fetch_orders(self, orders, is_known):
+        '''Complete the ledger with REST order details of the orders not known from the stream.'''
+        with self.stream_condition:
+            fetch_ids = [order.order_id for order in orders if not is_known(order)]
+
+        for detail in self.order_fetcher.fetch(fetch_ids, self.first_order_time):
+            if detail.state in FINAL_STATES:
+                with self.stream_condition:
+                    self.ledger.update_from_order(detail)
+
     def report(self):
-        orders = [
-            self.trade_client.get_order(order.order_id)
-            for order in self.buy_id + self.sell_id
-            if order.order_id
-        ]
+        orders = self.ledger.all()
+        self.fetch_orders(orders, lambda order: order.is_settled)
 
         order_info = [{
             'symbol': order.symbol,
-            'time': strftime(order.finished_at / 1000, fmt='%Y-%m-%d %H:%M:%S.%f'),
-            'price': round(float(order.filled_cash_amount) / float(order.filled_amount), 6),
-            'amount': round(float(order.filled_amount), 6),
-            'fee': round(float(order.filled_fees), 6),
+            'time': strftime(order.trade_time / 1000, fmt='%Y-%m-%d %H:%M:%S.%f'),
+            'price': round(order.avg_price, 6),
+            'amount': round(order.filled_amount, 6),
+            'fee': round(order.filled_fees, 6),
             'currency': order.symbol[:-4].upper(),
-            'vol': float(order.filled_cash_amount),
-            'direct': order.type.split('-')[0]}
+            'vol': order.filled_cash,
+            'direct': order.side}
             for order in orders
-            if order.state == 'filled'
+            if order.state == OrderState.FILLED
         ]
         buy_info = list(filter(lambda x: x['direct']=='buy', order_info))
         sell_info = list(filter(lambda x: x['direct']=='sell', order_info))
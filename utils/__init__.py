@@ -7,7 +7,7 @@ import time
 import pytz
 import requests
 from huobi.connection.impl.restapi_invoker import session
-from huobi.connection.impl.websocket_manage import websocket_connection_handler
+from huobi.connection.impl.websocket_manage import WebsocketManage, websocket_connection_handler
 from huobi.constant.system import RestApiDefine, WebSocketDefine
 from huobi.utils import PrintBasic
 
@@ -19,9 +19,6 @@ CONFIG_PATH = os.path.join(ROOT, 'config', 'config.ini')
 USER_CONFIG_PATH = os.path.join(ROOT, 'config', 'user.ini')
 LOG_PATH = os.path.join(ROOT, 'log', 'trade.log')
 
-URL = 'https://api-aws.huobi.pro'
-WS_URL = 'wss://api-aws.huobi.pro'
-
 logger = create_logger('goodmorning', LOG_PATH)
 config = configparser.ConfigParser()
 config.read(CONFIG_PATH)
@@ -30,6 +27,9 @@ user_config = configparser.ConfigParser()
 if os.path.exists(USER_CONFIG_PATH):
     user_config.read(USER_CONFIG_PATH)
 
+URL = config.get('setting', 'ExchangeUrl', fallback='https://api-aws.huobi.pro')
+WS_URL = config.get('setting', 'ExchangeWsUrl', fallback='wss://api-aws.huobi.pro')
+
 
 session._request = session.request
 session.request = lambda *args, **kwargs: session._request(timeout=1, *args, **kwargs)
@@ -37,6 +37,19 @@ WebSocketDefine.Uri = WS_URL
 RestApiDefine.Url = URL
 PrintBasic.print_basic = lambda data, name=None: None
 
+def websocket_manage_init(self, api_key, secret_key, uri, request):
+    # the sdk always builds wss://host/..., keep the scheme and port of WS_URL
+    WebsocketManage._init(self, api_key, secret_key, uri, request)
+    if request.is_trading:
+        self.url = f'{WS_URL}/ws/{request.api_version}'
+    elif request.is_mbp_feed:
+        self.url = f'{WS_URL}/feed'
+    else:
+        self.url = f'{WS_URL}/ws'
+
+WebsocketManage._init = WebsocketManage.__init__
+WebsocketManage.__init__ = websocket_manage_init
+
 
 def strftime(timestamp, tz_name='Asia/Shanghai', fmt='%Y-%m-%d %H:%M:%S'):
     tz = pytz.timezone(tz_name)
@@ -45,9 +58,9 @@ def strftime(timestamp, tz_name='Asia/Shanghai', fmt='%Y-%m-%d %H:%M:%S'):
     )
     return utc_time.astimezone(tz).strftime(fmt)
 
-def get_target_time():
+def get_target_time(now=None):
     TIME = config.get('setting', 'Time')
-    now = time.time()
+    now = now or time.time()
 
     if TIME.startswith('*/'):
         TIME = int(TIME[2:])
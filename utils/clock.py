@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import deque
+
+from huobi.client.generic import GenericClient
+
+from utils import config, logger
+from utils.metrics import LATENCY
+
+CLOCK_SYNC_INTERVAL = config.getfloat('setting', 'ClockSyncInterval')
+CLOCK_SAMPLE_NUM = 8
+# exchange timestamps are in ms
+SERVER_RESOLUTION = 0.0005
+
+
+class ClockSync(threading.Thread):
+    '''Estimate the offset of the exchange clock from periodic server time samples.
+
+    The offset of the sample with the lowest RTT in a sliding window is used,
+    its error is bounded by half of that RTT plus the server resolution.'''
+    def __init__(self, interval=CLOCK_SYNC_INTERVAL, sample_num=CLOCK_SAMPLE_NUM):
+        super().__init__(name='ClockSync', daemon=True)
+        self.interval = interval
+        self.samples = deque(maxlen=sample_num)
+        self.offset = 0
+        self.rtt = 0
+        self.error = float('inf')
+        self.generic_client = GenericClient()
+
+    def now(self):
+        return time.time() + self.offset
+
+    def sample(self):
+        start = time.time()
+        server = self.generic_client.get_exchange_timestamp() / 1000
+        end = time.time()
+        self.samples.append((end - start, server - (start + end) / 2))
+
+        self.rtt, self.offset = min(self.samples)
+        self.error = self.rtt / 2 + SERVER_RESOLUTION
+        LATENCY.set_gauge('clock_offset_ms', round(self.offset * 1000, 3))
+        LATENCY.set_gauge('clock_error_ms', round(self.error * 1000, 3))
+
+    def start(self):
+        try:
+            self.sample()
+            logger.info(f'Clock offset {round(self.offset * 1000, 3)}ms, error {round(self.error * 1000, 3)}ms')
+        except Exception as e:
+            logger.error(f'Fail to sync clock, {e}')
+        super().start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f'Fail to sync clock, {e}')
+
+
+CLOCK = ClockSync()
+# latency stages start from exchange trade ts
+LATENCY.clock = CLOCK.now
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from huobi.connection.impl.restapi_invoker import session
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from utils import URL, config, logger
+from utils.clock import CLOCK
+from utils.metrics import LATENCY
+
+POOL_SIZE = config.getint('setting', 'PoolSize')
+WARM_INTERVAL = config.getfloat('setting', 'WarmInterval')
+WARM_AHEAD = config.getfloat('setting', 'WarmAhead')
+WARM_PATH = '/v1/common/timestamp'
+
+
+# urllib3 connects in the thread sending the request, so handshakes and
+# requests are matched per thread
+LOCAL = threading.local()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.time()
+        super().connect()
+        LOCAL.connect_num = getattr(LOCAL, 'connect_num', 0) + 1
+        if not getattr(LOCAL, 'warming', False):
+            LATENCY.record('handshake', start)
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class PooledAdapter(HTTPAdapter):
+    '''Keep a sized pool of TLS connections, time new handshakes and requests.'''
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self.warm_target = None
+        self.warm_thread = None
+        super().__init__(pool_connections=2, pool_maxsize=pool_size)
+
+    def resize(self, pool_size):
+        self.pool_size = pool_size
+        self._pool_maxsize = pool_size
+        self.init_poolmanager(self._pool_connections, pool_size, block=self._pool_block)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': HTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+    @property
+    def last_reused(self):
+        '''Whether the last request of this thread went on a kept connection.'''
+        return getattr(LOCAL, 'last_reused', None)
+
+    def send(self, request, **kwargs):
+        num = getattr(LOCAL, 'connect_num', 0)
+        start = time.time()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            LOCAL.last_reused = getattr(LOCAL, 'connect_num', 0) == num
+            if not getattr(LOCAL, 'warming', False):
+                LATENCY.record('request' if LOCAL.last_reused else 'request_new', start)
+
+    def warm(self):
+        '''Open or keep alive every connection of the pool with a cheap public request.'''
+        def ping():
+            # warm up requests are kept out of the latency stages
+            LOCAL.warming = True
+            try:
+                session._request('GET', URL + WARM_PATH, timeout=1)
+            except Exception as e:
+                logger.error(f'Warm connection failed, {e}')
+
+        threads = [threading.Thread(target=ping) for _ in range(self.pool_size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def keep_warm(self, target_time, interval=WARM_INTERVAL, ahead=WARM_AHEAD):
+        '''Warm the pool from ahead seconds until just before target time, run in background.
+
+        Called again while running, the thread follows the new target time.'''
+        def warpper():
+            while CLOCK.now() < self.warm_target - 1:
+                if CLOCK.now() >= self.warm_target - ahead:
+                    self.warm()
+                time.sleep(max(min(interval, self.warm_target - 1 - CLOCK.now()), 0))
+            logger.info(f'Connection pool warmed, {self.pool_size} connections')
+
+        self.warm_target = target_time
+        if not self.warm_thread or not self.warm_thread.is_alive():
+            self.warm_thread = threading.Thread(target=warpper)
+            self.warm_thread.start()
+        return self.warm_thread
+
+
+ADAPTER = PooledAdapter()
+session.mount('https://', ADAPTER)
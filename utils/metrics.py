@@ -0,0 +1,114 @@
+import math
+import threading
+import time
+
+SUB_BUCKET = 16
+BUCKET_NUM = 48 * SUB_BUCKET
+
+
+def bucket_index(us):
+    if us < 1:
+        return 0
+    mantissa, exponent = math.frexp(us)
+    return min(exponent * SUB_BUCKET + int((mantissa - 0.5) * 2 * SUB_BUCKET), BUCKET_NUM - 1)
+
+def bucket_upper(index):
+    exponent, sub = divmod(index, SUB_BUCKET)
+    return (0.5 + (sub + 1) / (2 * SUB_BUCKET)) * 2 ** exponent
+
+
+class Histogram:
+    '''Log-linear histogram of microseconds, 16 buckets per power of two.'''
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_NUM
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, us):
+        self.counts[bucket_index(us)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, percent):
+        rank = self.count * percent / 100
+        num = 0
+        for index, count in enumerate(self.counts):
+            num += count
+            if count and num >= rank:
+                return min(bucket_upper(index), self.max)
+        return self.max
+
+    def summary(self) -> 'dict[str, float]':
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 1) if self.count else 0,
+            'p50': round(self.percentile(50), 1),
+            'p90': round(self.percentile(90), 1),
+            'p99': round(self.percentile(99), 1),
+            'max': round(self.max, 1)
+        }
+
+
+class Latency:
+    '''Per process latency of each stage, measured from the exchange trade ts.'''
+    STAGES = ['callback', 'decision', 'publish', 'receive', 'prepare', 'order', 'balance']
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # recorded from the websocket, fan-out and delayed task threads
+        self.lock = threading.Lock()
+        self.histograms = self.new_histograms()
+        self.negative: 'dict[str, int]' = {}
+        self.gauges: 'dict[str, float]' = {}
+
+    def new_histograms(self) -> 'dict[str, Histogram]':
+        return {stage: Histogram() for stage in self.STAGES}
+
+    def record(self, stage, start, end=None):
+        us = ((end or self.clock()) - start) * 1e6
+        with self.lock:
+            if us < 0:
+                # clock skew with the exchange, a 0 would hide it in the low buckets
+                self.negative[stage] = self.negative.get(stage, 0) + 1
+                return
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].record(us)
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def dump(self, logger, reset=True) -> 'dict[str, dict[str, float]]':
+        with self.lock:
+            histograms, negative = self.histograms, self.negative
+            if reset:
+                self.histograms = self.new_histograms()
+                self.negative = {}
+
+            summary = {
+                stage: histograms[stage].summary()
+                for stage in self.STAGES + sorted(set(histograms) - set(self.STAGES))
+                if stage in histograms and histograms[stage].count
+            }
+            negative = dict(negative)
+
+        for stage, info in summary.items():
+            logger.info(
+                f'Latency {stage}: count {info["count"]}, mean {info["mean"]}us, '
+                f'p50 {info["p50"]}us, p90 {info["p90"]}us, p99 {info["p99"]}us, max {info["max"]}us'
+            )
+
+        for stage, num in negative.items():
+            logger.warning(f'Latency {stage}: {num} negative durations skipped')
+
+        for name, value in self.gauges.items():
+            logger.info(f'Gauge {name}: {value}')
+        return summary
+
+
+LATENCY = Latency()
@@ -1,4 +1,8 @@
+import heapq
+import itertools
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from huobi.model.generic.symbol import Symbol
 
 from wampy.constants import DEFAULT_REALM, DEFAULT_ROLES, DEFAULT_TIMEOUT
@@ -8,10 +12,12 @@ from wampy.roles.subscriber import subscribe
 
 from utils.logging import quite_logger
 from market import MarketClient
-from dataset.redis import Redis
+from dataset.redis import Redis, TradeWriter
 from target import Target
 from user import User
 from utils import config, get_target_time, logger
+from utils.clock import CLOCK
+from utils.metrics import LATENCY
 
 DEALER_NUM = config.getint('setting', 'DealerNum')
 WATCHER_NUM = config.getint('setting', 'WatcherNum')
@@ -46,6 +52,32 @@ class State:
 quite_logger(all_logger=True)
 
 
+class DelayedTasks(threading.Thread):
+    def __init__(self):
+        super().__init__(name='DelayedTasks', daemon=True)
+        self.tasks = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.start()
+
+    def call_later(self, delay, func, *args):
+        with self.condition:
+            heapq.heappush(self.tasks, (time.time() + delay, next(self.counter), func, args))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.tasks or self.tasks[0][0] > time.time():
+                    self.condition.wait(self.tasks[0][0] - time.time() if self.tasks else None)
+                _, _, func, args = heapq.heappop(self.tasks)
+
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(e)
+
+
 class ControlledClient(Client):
     def __init__(
         self, url=WS_URL, cert_path=None, ipv=4, name=None,
@@ -60,6 +92,7 @@ class ControlledClient(Client):
         self.state = State.STOPPED
         self.target_time = None
         self.client_type = 'unknown'
+        self.delayed_tasks = DelayedTasks()
 
     @subscribe(topic=Topic.STATE)
     def state_handler(self, state, *args, **kwargs):
@@ -112,23 +145,31 @@ class WatcherClient(ControlledClient):
         self.task : list[str] = []
         self.targets : list[Target] = {}
         self.redis_conn: Redis = Redis()
+        self.trade_writer: TradeWriter = TradeWriter(self.redis_conn)
+
+    def stop(self):
+        super().stop()
+        self.trade_writer.close()
 
     def get_task(self, num) -> 'list[str]':
         self.task = self.rpc.req_task(num)
 
     def send_buy_signal(self, symbol, price, init_price, now, vol, start_time):
+        LATENCY.record('decision', now)
         if start_time - now > 0.2:
             logger.info(f'Buy signal. {symbol} with price {price}USDT, vol {vol} at {now}. Recieved at {start_time}. Too late')
             return
 
         self.publish(topic=Topic.BUY_SIGNAL, symbol=symbol, price=price, init_price=init_price, vol=vol, now=now)
+        LATENCY.record('publish', now)
         target = Target(symbol, price, init_price, now)
         self.targets[symbol] = target
         increase = round((price - init_price) / init_price * 100, 4)
         logger.info(f'Buy signal. {symbol} with price {price}USDT, vol {vol}, increament {increase}% at {now}. recieved at {start_time}')
+        self.delayed_tasks.call_later(1, self.check_target, symbol)
 
-        time.sleep(1)
-        if target.buy_price == 0:
+    def check_target(self, symbol):
+        if symbol in self.targets and self.targets[symbol].buy_price == 0:
             del self.targets[symbol]
         self.redis_conn.write_target(symbol)
 
@@ -233,7 +274,8 @@ class WatcherMasterClient(WatcherClient):
     def running(self):
         if self.state != State.RUNNING:
             self.set_state(State.RUNNING)
-            self.set_time(get_target_time())
+            self.set_time(get_target_time(CLOCK.now()))
+            self.delayed_tasks.call_later(self.target_time + SELL_AFTER - CLOCK.now(), self.stop_running)
             logger.info(f"Change state to running")
 
     def stopping(self):
@@ -269,8 +311,10 @@ class DealerClient(ControlledClient):
     def buy_signal_handler(self, symbol, price, init_price, vol, now, *args, **kwargs):
         if self.state != State.RUNNING or symbol in self.targets or len(self.targets) >= MAX_BUY:
             return
-        start_time = time.time()
+        start_time = CLOCK.now()
+        LATENCY.record('receive', now, start_time)
         target = Target(symbol, price, init_price, now)
+        target.receive_time = start_time
         self.targets[symbol] = target
         target.set_info(self.market_client.symbols_info[symbol])
 
@@ -296,6 +340,94 @@ class DealerClient(ControlledClient):
         if self.state != State.RUNNING:
             return
 
-        time.sleep(HIGH_SELL_SLEEP)
-        self.user.high_cancel_and_sell(self.targets.values(), symbol, price)
+        self.delayed_tasks.call_later(HIGH_SELL_SLEEP, self.high_sell, symbol, price)
+
+    def high_sell(self, symbol, price):
+        self.user.high_cancel_and_sell(list(self.targets.values()), symbol, price)
         logger.info(f'Stop profit {symbol} at {price} USDT')
+
+
+class MultiDealerClient(DealerClient):
+    '''One dealer for all users, sharing the market snapshot and WAMP session.'''
+    def __init__(
+        self, market_client: MarketClient,
+        users: 'list[User]',
+        url=WS_URL, cert_path=None, ipv=4, name=None,
+        realm=DEFAULT_REALM, roles=DEFAULT_ROLES, call_timeout=DEFAULT_TIMEOUT,
+        message_handler_cls=None
+    ):
+        super().__init__(
+            market_client, users[0],
+            url=url, cert_path=cert_path, ipv=ipv, name=name,
+            realm=realm, roles=roles, call_timeout=call_timeout,
+            message_handler_cls=message_handler_cls
+        )
+        self.users : 'list[User]' = users
+        self.user_targets : 'dict[int, dict[str, Target]]' = {user.account_id: {} for user in users}
+        self.executor = ThreadPoolExecutor(len(users))
+
+    def fan_out(self, func, users, *args_list):
+        def warpper(user, *args):
+            try:
+                return func(user, *args)
+            except Exception as e:
+                logger.error(f'User {user.account_id} {e}')
+
+        return list(self.executor.map(warpper, users, *args_list))
+
+    @subscribe(topic=Topic.BUY_SIGNAL)
+    def buy_signal_handler(self, symbol, price, init_price, vol, now, *args, **kwargs):
+        if self.state != State.RUNNING:
+            return
+
+        users = [
+            user for user in self.users
+            if symbol not in self.user_targets[user.account_id]
+            and len(self.user_targets[user.account_id]) < MAX_BUY
+        ]
+        if not users:
+            return
+
+        start_time = CLOCK.now()
+        LATENCY.record('receive', now, start_time)
+        info = self.market_client.symbols_info[symbol]
+        targets = []
+        for user in users:
+            target = Target(symbol, price, init_price, now)
+            target.receive_time = start_time
+            target.set_info(info)
+            self.user_targets[user.account_id][symbol] = target
+            targets.append(target)
+
+        self.fan_out(lambda user, target: user.buy_and_sell([target]), users, targets)
+
+        buy_prices = []
+        for user, target in zip(users, targets):
+            if target.buy_price > 0:
+                buy_prices.append(target.buy_price)
+            else:
+                del self.user_targets[user.account_id][symbol]
+
+        if buy_prices:
+            self.publish(topic=Topic.AFTER_BUY, symbol=symbol, price=min(buy_prices))
+        logger.info(f'Buy {symbol} for {len(buy_prices)} users, recieved at {start_time}')
+
+    @subscribe(topic=Topic.SELL_SIGNAL)
+    def sell_signal_handler(self, symbol, price, init_price, vol, now, *args, **kwargs):
+        if self.state != State.RUNNING:
+            return
+
+        users = [user for user in self.users if symbol in self.user_targets[user.account_id]]
+        self.fan_out(lambda user: user.cancel_and_sell([self.user_targets[user.account_id][symbol]]), users)
+        logger.info(f'Stop loss{symbol} at {price} USDT')
+
+    def high_sell(self, symbol, price):
+        self.fan_out(lambda user: user.high_cancel_and_sell(
+            list(self.user_targets[user.account_id].values()), symbol, price
+        ), self.users)
+        logger.info(f'Stop profit {symbol} at {price} USDT')
+
+    def cancel_and_sell(self):
+        self.fan_out(lambda user: user.cancel_and_sell(
+            list(self.user_targets[user.account_id].values())
+        ), self.users)
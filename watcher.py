@@ -1,4 +1,5 @@
 import sys
+import threading
 import time
 
 # from apscheduler.schedulers.blocking import BlockingScheduler as Scheduler
@@ -8,11 +9,12 @@ from huobi.model.market.trade_detail import TradeDetail
 from retry import retry
 
 from market import MarketClient
+from symbol_state import SymbolState, VectorState
 from utils import config, kill_all_threads, logger
+from utils.clock import CLOCK
+from utils.metrics import LATENCY
 from websocket_handler import replace_watch_dog, WatchDog
 
-BOOT_RATE = config.getfloat('setting', 'BootRate')
-END_RATE = config.getfloat('setting', 'EndRate')
 MIN_VOL = config.getfloat('setting', 'MinVol')
 SELL_AFTER = config.getfloat('setting', 'SellAfter')
 MAX_WAIT = config.getfloat('setting', 'MaxWait')
@@ -20,6 +22,8 @@ MAX_BUY_BACK_RATE = config.getfloat('setting', 'MaxBuyBackRate')
 
 WATCHER_TASK_NUM = config.getint('setting', 'WatcherTaskNum')
 WATCHER_SLEEP = config.getint('setting', 'WatcherSleep')
+WATCHER_CHANNEL_NUM = config.getint('setting', 'WatcherChannelNum')
+VECTOR_INTERVAL = config.getint('setting', 'VectorInterval')
 
 def check_buy_signal(client: WatcherClient, symbol, vol, open_, price, now, boot_price, end_price, start_time, max_back):
     if vol < MIN_VOL or max_back > MAX_BUY_BACK_RATE:
@@ -33,7 +37,7 @@ def check_buy_signal(client: WatcherClient, symbol, vol, open_, price, now, boot
 
 def check_sell_signal(client: WatcherClient, symbol, vol, open_, close, now, start_time):
     target = client.targets[symbol]
-    if not target.own:
+    if not target.own or not target.buy_price:
         return
 
     if close > target.high_price:
@@ -48,78 +52,153 @@ def check_sell_signal(client: WatcherClient, symbol, vol, open_, close, now, sta
         except Exception as e:
             logger.error(e)
 
-def trade_detail_callback(symbol: str, client: WatcherClient, interval=300, redis=True):
+def trade_detail_callback(symbol: str, client: WatcherClient, interval=300, redis=True, clock=CLOCK.now):
     def warpper(event: TradeDetailEvent):
         if not event.data:
             return
         
-        start_time = time.time()
+        start_time = clock()
         detail: TradeDetail = event.data[0]
         now = detail.ts / 1000
 
         if client.state == State.RUNNING and 0 < now - client.target_time < MAX_WAIT:
-            last = now // interval
-            price = detail.price
-            vol = sum([each.price * each.amount for each in event.data])
-
-            if last > info['last']:
-                info['last'] = last
-                info['open_'] = event.data[-1].price
-                info['vol'] = vol
-                info['boot_price'] = info['open_'] * (1 + BOOT_RATE / 100)
-                info['end_price'] = info['open_'] * (1 + END_RATE / 100)
-                info['high'] = max(info['open_'], price)
-            else:
-                info['vol'] += vol
-                info['high'] = max(info['high'], price)
-                info['max_back'] = max(info['max_back'], 1 - price / info['high'])
-                
+            LATENCY.record('callback', now, start_time)
+            buy_ready = state.update(event.data)
+
             if symbol in client.targets:
-                check_sell_signal(client, symbol, info['vol'], info['open_'], price, now, start_time)
+                check_sell_signal(client, symbol, state.vol, state.open_, state.price, now, start_time)
 
-            elif now < client.target_time + SELL_AFTER:
+            elif buy_ready and now < client.target_time + SELL_AFTER:
                 check_buy_signal(
-                    client, symbol, info['vol'], info['open_'],
-                    price, now, info['boot_price'], info['end_price'],
-                    start_time, info['max_back']
+                    client, symbol, state.vol, state.open_,
+                    state.price, now, state.boot_price, state.end_price,
+                    start_time, state.max_back
                 )
 
         if redis:
-            client.redis_conn.write_trade(symbol, event.data)
-
-
-    info = {
-        'last': 0,
-        'vol': 0,
-        'open_': 0,
-        'high': 0,
-        'boot_price': 0,
-        'end_price': 0,
-        'max_back': 0,
-    }
+            client.trade_writer.write_trade(symbol, event.data)
+
+    state = SymbolState(symbol, interval)
     return warpper
 
+class VectorEngine(threading.Thread):
+    def __init__(self, client: WatcherClient, symbols, interval=VECTOR_INTERVAL):
+        super().__init__(name='VectorEngine', daemon=True)
+        self.client = client
+        self.state = VectorState(symbols)
+        self.interval = interval / 1000
+        self.start()
+
+    def callback(self, symbol: str, redis=True):
+        def warpper(event: TradeDetailEvent):
+            if not event.data:
+                return
+
+            start_time = CLOCK.now()
+            now = event.data[0].ts / 1000
+            if client.state == State.RUNNING and 0 < now - client.target_time < MAX_WAIT:
+                LATENCY.record('callback', now, start_time)
+                state.push(index, event.data)
+
+            if redis:
+                client.trade_writer.write_trade(symbol, event.data)
+
+        client = self.client
+        state = self.state
+        index = state.index[symbol]
+        return warpper
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                symbols = self.state.apply()
+                if len(symbols):
+                    self.check(symbols)
+            except Exception as e:
+                logger.error(f'Vector engine fail to check, {e}')
+
+    def check(self, symbols):
+        client = self.client
+        state = self.state
+        start_time = CLOCK.now()
+        # other threads remove targets while the state is filled
+        state.set_targets(dict(client.targets))
+        buy, high_sell, sell = state.check(symbols)
+        buy = buy[state.now[buy] < (client.target_time + SELL_AFTER) * 1000]
+
+        for index in high_sell:
+            try:
+                client.send_high_sell_signal(state.symbols[index], start_time)
+            except Exception as e:
+                logger.error(e)
+
+        for index in sell:
+            # a high sell above stops every target, state was taken before it
+            target = client.targets.get(state.symbols[index])
+            if not target or not target.own:
+                continue
+
+            try:
+                client.send_sell_signal(
+                    state.symbols[index], state.price[index], state.open_[index],
+                    state.now[index] / 1000, state.vol[index], start_time
+                )
+            except Exception as e:
+                logger.error(e)
+
+        for index in buy:
+            try:
+                client.send_buy_signal(
+                    state.symbols[index], state.price[index], state.open_[index],
+                    state.now[index] / 1000, state.vol[index], start_time
+                )
+            except Exception as e:
+                logger.error(e)
+
 def error_callback(symbol):
     def warpper(error):
         logger.error(f'[{symbol}] {error}')
     
     return warpper
 
+def multiplex_callback(callbacks):
+    def warpper(event: TradeDetailEvent):
+        callbacks[event.ch](event)
+
+    return warpper
+
+def sub_trade_detail(
+    client: WatcherClient, watch_dog: WatchDog, symbols, redis=True,
+    channel_num=WATCHER_CHANNEL_NUM, engine: VectorEngine=None
+):
+    for i, start in enumerate(range(0, len(symbols), channel_num)):
+        channel_symbols = symbols[start:start+channel_num]
+        name = ','.join(channel_symbols)
+        callbacks = {}
+        for symbol in channel_symbols:
+            if engine and symbol in engine.state.index:
+                callback = engine.callback(symbol, redis=redis)
+            else:
+                callback = trade_detail_callback(symbol, client, redis=redis)
+            callbacks[f'market.{symbol}.trade.detail'] = callback
+
+        client.market_client.sub_trade_detail(
+            name, multiplex_callback(callbacks), error_callback(name)
+        )
+        watch_dog.after_connection_created(name)
+        if not i % 10:
+            time.sleep(0.5)
+
 def update_symbols(client: WatcherClient, watch_dog: WatchDog):
     new_symbols, _ = client.market_client.update_symbols_info()
     if new_symbols:
         logger.info(f'Find new symbols: {", ".join(new_symbols)}')
-        for i, symbol in enumerate(new_symbols):
-            client.market_client.sub_trade_detail(
-                symbol, trade_detail_callback(symbol, client), error_callback(symbol)
-            )
-            watch_dog.after_connection_created(symbol)
-            if not i % 10:
-                time.sleep(0.5)
+        sub_trade_detail(client, watch_dog, new_symbols)
 
 @retry(tries=5, delay=1, logger=logger)
 def init_watcher(Client=WatcherClient) -> WatcherClient:
-    market_client = MarketClient()
+    market_client = MarketClient(publisher=issubclass(Client, WatcherMasterClient))
     client = Client(market_client)
     client.start()
     return client
@@ -128,19 +207,22 @@ def main():
     is_master = len(sys.argv) > 1 and sys.argv[1] == 'master'
     is_wait_stop = len(sys.argv) <= 1 or sys.argv[1] != 'nowait'
     watch_dog = replace_watch_dog()
+    CLOCK.start()
 
     if is_master:
         logger.info('Master watcher')
         client : WatcherMasterClient = init_watcher(WatcherMasterClient)
         client.get_task(WATCHER_TASK_NUM)
         watch_dog.scheduler.add_job(client.running, trigger='cron', hour=23, minute=59, second=30)
-        watch_dog.scheduler.add_job(client.stop_running, trigger='cron', hour=0, minute=0, second=int(SELL_AFTER))
         watch_dog.scheduler.add_job(client.stopping, trigger='cron', hour=23, minute=56, second=0)
         watch_dog.scheduler.add_job(update_symbols, trigger='cron', minute='*/5', kwargs={'client': client, 'watch_dog': watch_dog})
+        if client.market_client.from_cache:
+            watch_dog.scheduler.add_job(update_symbols, kwargs={'client': client, 'watch_dog': watch_dog})
         client.starting()
     else:
         logger.info('Sub watcher')
         client : WatcherClient = init_watcher(WatcherClient)
+        client.market_client.reconcile()
         client.wait_state(State.STARTED)
         client.get_task(WATCHER_TASK_NUM)
 
@@ -148,16 +230,12 @@ def main():
         return
 
     logger.info(f'Watcher task are: {", ".join(client.task)}')
-    for i, symbol in enumerate(client.task):
-        client.market_client.sub_trade_detail(
-            symbol, trade_detail_callback(symbol, client, redis=is_wait_stop), error_callback
-        )
-        watch_dog.after_connection_created(symbol)
-        if not i % 10:
-            time.sleep(0.5)
+    engine = VectorEngine(client, client.task) if VECTOR_INTERVAL else None
+    sub_trade_detail(client, watch_dog, client.task, redis=is_wait_stop, engine=engine)
 
     client.wait_state(State.RUNNING)
     client.wait_state(State.STARTED)
+    LATENCY.dump(logger)
     if is_wait_stop:
         client.wait_state(State.STOPPED)
 